@@ -51,12 +51,24 @@ def _router(parser):
     parser.add_argument('router', nargs=nargs, default=default, help='router on which the packages will be installed')
 
 
+def _routers(parser):
+    default = config.default.get('router', None)
+    nargs = '*' if default else '+'
+    parser.add_argument(
+        'router', nargs=nargs, default=[default], help='routers (names, roles or tags) on which the packages will be installed'
+    )
+
+
 def _server(parser):
     default = config.default.get('build', None)
     nargs = '?' if default else None
     parser.add_argument('server', nargs=nargs, default=default, help='server on which the action will be performed')
 
 
+def _action(parser):
+    parser.add_argument('action', choices=['list', 'prune'], help='list the stored images or remove the least used ones')
+
+
 @register('target')
 def _target(parser):
     parser.add_argument('target', help='target to create', default='./vyos')
@@ -66,13 +78,25 @@ def _target(parser):
 
 def _backdoor(parser):
     # to dangerous to have a -b option
-    parser.add_argument('--backdoor', action='store_true', help='install an admin account on the iso with this passord')
+    parser.add_argument('--backdoor', type=str, default='', help='install an admin account on the iso with this passord')
+
+
+def _batch(parser):
+    parser.add_argument('--batch', action='store_true', help='send all the commands as one script over one ssh session')
 
 
 def _bind(parser):
     parser.add_argument('--bind', '-b', metavar="IP", type=int, help='ip to bind the webserver to')
 
 
+def _canary(parser):
+    parser.add_argument('--canary', type=int, default=1, help='how many routers are upgraded alone before the others')
+
+
+def _clean(parser):
+    parser.add_argument('--clean', action='store_true', help='remove all the sources and packages of previous builds')
+
+
 def _debug(parser):
     parser.add_argument('--debug', '-d', help='run python with pdb', action='store_true')
 
@@ -97,6 +121,14 @@ def _quiet(parser):
     parser.add_argument('--quiet', '-q', action='store_true', help='do not show what is happening')
 
 
+def _force(parser):
+    parser.add_argument('--force', action='store_true', help='install the image even if the router already has it')
+
+
+def _jobs(parser):
+    parser.add_argument('--jobs', '-j', type=int, default=8, help='how many commands to run at the same time')
+
+
 def _local(parser):
     parser.add_argument('--local', '-l', metavar="PORT", type=int, default=8088, help='port to bind the webserver')
 
@@ -109,14 +141,31 @@ def _name(parser):
     parser.add_argument('--name', '-n', type=str, help='name/tag to add to the build version')
 
 
+def _rebuild(parser):
+    parser.add_argument('--rebuild', action='store_true', help='do not use previously built packages')
+
+
 def _release(parser):
     parser.add_argument('--release', '-r', type=str, help='make without custom package', choices=['current', 'crux'])
 
 
+def _reload(parser):
+    parser.add_argument('--reload', action='store_true', help='check and reload the code on the router once copied')
+
+
 def _remote(parser):
     parser.add_argument('--remote', '-r',  metavar="PORT", type=int, help='ssh forward port to bind the router')
 
 
+def _stage(parser):
+    parser.add_argument(
+        '--stage',
+        choices=['http', 'gzip', 'delta'],
+        default='http',
+        help='how the image reaches the router: streamed, compressed, or only what changed since the last one',
+    )
+
+
 def _test(parser):
     parser.add_argument('--test', '-t', help='test the iso when built', action='store_true')
 
@@ -130,10 +179,24 @@ def _save(parser):
     parser.add_argument('--save', '-s', help='location where to save', action='store_true')
 
 
+def _sha256(parser):
+    parser.add_argument('--sha256', type=str, default='', help='the expected checksum of the image')
+
+
 def _sudo(parser):
     parser.add_argument('--sudo', action='store_true', help='also setup sudo on this machine')
 
 
+def _timeout(parser):
+    parser.add_argument('--timeout', metavar="SECONDS", type=int, default=60, help='give up on a command after this time')
+
+
+def _wait(parser):
+    parser.add_argument(
+        '--wait', metavar="SECONDS", type=int, default=600, help='how long a rebooted router has to be reachable again'
+    )
+
+
 def _working(parser):
     parser.add_argument(
         '-w', '--working', type=str, default='.', help='where the branch root is (where vyos repos where cloned)'
@@ -152,9 +215,12 @@ def edit(parser):
 @register('build')
 def build(parser):
     _server(parser)
-    _router(parser)
+    _routers(parser)
     # --
     _packages(parser)
+    _jobs(parser)
+    _rebuild(parser)
+    _clean(parser)
     _working(parser)
     _dry(parser)
     _quiet(parser)
@@ -181,6 +247,7 @@ def docker(parser):
 @register('download')
 def download(parser):
     _save(parser)
+    _sha256(parser)
     _dry(parser)
     _quiet(parser)
 
@@ -202,6 +269,9 @@ def _make(parser):
     _name(parser)
     _backdoor(parser)
     _packages(parser)
+    _jobs(parser)
+    _rebuild(parser)
+    _clean(parser)
     _release(parser)
     _test(parser)
     _save(parser)
@@ -215,6 +285,9 @@ def _make(parser):
 def test(parser):
     _machine(parser)
     # --
+    _batch(parser)
+    _jobs(parser)
+    _timeout(parser)
     _dry(parser)
     _quiet(parser)
 
@@ -235,6 +308,7 @@ def update(parser):
     _router(parser)
     # --
     _packages(parser)
+    _reload(parser)
     _working(parser)
     _dry(parser)
     _quiet(parser)
@@ -242,12 +316,19 @@ def update(parser):
 
 @register('upgrade')
 def upgrade(parser):
-    _router(parser)
+    _routers(parser)
     # --
+    _canary(parser)
+    _jobs(parser)
+    _timeout(parser)
+    _wait(parser)
     _bind(parser)
     _local(parser)
     _remote(parser)
     _iso(parser)
+    _sha256(parser)
+    _force(parser)
+    _stage(parser)
     _packages(parser)
     _working(parser)
     _save(parser)
@@ -265,6 +346,14 @@ def release(parser):
     _quiet(parser)
 
 
+@register('store')
+def store(parser):
+    _action(parser)
+    # --
+    _dry(parser)
+    _quiet(parser)
+
+
 @register('setup')
 def mysetup(parser):
     _machine(parser)
@@ -0,0 +1,43 @@
+import collections
+
+
+class Capture(object):
+    '''
+    collect the output of a command as a list of chunks (joined once when
+    read) rather than by string concatenation, keeping at most the last
+    "limit" characters in memory (0: no limit), and optionally writing
+    everything to a spill file for later inspection
+    '''
+
+    def __init__(self, limit=0, spill=None):
+        self.limit = limit
+        self.spill = spill
+        self.total = 0
+        self._size = 0
+        self._chunks = collections.deque()
+
+    def write(self, text):
+        if not text:
+            return
+
+        self.total += len(text)
+        if self.spill:
+            self.spill.write(text)
+
+        self._chunks.append(text)
+        self._size += len(text)
+
+        # drop the oldest chunks which are not needed to return the tail
+        while self.limit and len(self._chunks) > 1 and self._size - len(self._chunks[0]) >= self.limit:
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        value = ''.join(self._chunks)
+        if self.limit:
+            value = value[-self.limit :]
+        self._chunks = collections.deque([value])
+        self._size = len(value)
+        return value
+
+    def __str__(self):
+        return self.getvalue()
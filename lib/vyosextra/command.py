@@ -1,67 +1,197 @@
 import os
 import sys
 import time
-import fcntl
+import codecs
+import selectors
 
-from subprocess import Popen
-from subprocess import PIPE
-from subprocess import DEVNULL
+from subprocess import TimeoutExpired
 
 from vyosextra import log
+from vyosextra.capture import Capture
+from vyosextra.transport import transport
 
 
 def _unprefix(string, prefix='Welcome to VyOS'):
     return '\n'.join(_ for _ in string.split('\n') if _ and _ != prefix)
 
 
-def _report(popen, verbose):
-    def _blocking(output):
-        fd = output.fileno()
-        os.set_blocking(fd, True)
+def _exited(popen):
+    # a file descriptor readable once the process exits (linux 5.3+)
+    # so children keeping our pipes open do not delay us
+    try:
+        return os.pidfd_open(popen.pid)
+    except (AttributeError, OSError):
+        return None
 
-    def _non_blocking(output):
-        fd = output.fileno()
-        os.set_blocking(fd, False)
 
-    def _read(output):
+class _Collect(object):
+    # decode, record, display and capture what a command outputs
+
+    def __init__(self, verbose, limit=0, spill=''):
+        self.verbose = verbose
+        # how many bytes were received on stdout and stderr
+        self.sizes = {1: 0, 2: 0}
+        self.output = open(spill, 'a') if spill else None
+        self.standards = {
+            1: (sys.stdout, lambda _: _, self._decoder(), Capture(limit, self.output)),
+            2: (sys.stderr, _unprefix, self._decoder(), Capture(limit, self.output)),
+        }
+
+    @staticmethod
+    def _decoder():
+        return codecs.getincrementaldecoder('utf-8')('replace')
+
+    def feed(self, fno, data):
+        std, formater, decoder, capture = self.standards[fno]
+        self.sizes[fno] += len(data)
+        short = formater(decoder.decode(data, final=not data))
+        if not short:
+            return
+
+        log.answer(short)
+        capture.write(short)
+        if self.verbose:
+            std.write(short)
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+        return self.standards[1][3].getvalue(), self.standards[2][3].getvalue(), self.sizes
+
+
+def _drain(collect, standards):
+    # the process is gone, collect what is left without blocking
+    for fd, fno in standards.items():
+        os.set_blocking(fd, False)
         try:
-            return output.read().decode()
-        except Exception:
-            return ""
+            while True:
+                data = os.read(fd, 65536)
+                collect.feed(fno, data)
+                if not data:
+                    break
+        except BlockingIOError:
+            pass
+        finally:
+            os.set_blocking(fd, True)
+
+
+def _left(popen, deadline, timeout):
+    # how long to wait before the timeout (None: forever), killing the process once reached
+    if not deadline:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        popen.kill()
+        popen.wait()
+        log.answer(f'killed after {timeout} seconds')
+        raise TimeoutExpired(popen.args, timeout)
+    return left
+
+
+def _select(popen, collect, standards, pidfd, timeout):
+    # wake up only when there is data, the pipes are closed or the
+    # process exits (without pidfd, check it every second instead)
+    deadline = time.monotonic() + timeout if timeout else 0
+    with selectors.DefaultSelector() as selector:
+        for fd in standards:
+            selector.register(fd, selectors.EVENT_READ)
+        if pidfd is not None:
+            selector.register(pidfd, selectors.EVENT_READ)
 
-    _non_blocking(popen.stdout)
-    _non_blocking(popen.stderr)
+        while standards:
+            left = _left(popen, deadline, timeout)
+            wait = left if pidfd is not None else min(1.0, left or 1.0)
 
-    result = {1: '', 2: ''}
+            events = selector.select(wait)
+            if any(key.fd == pidfd for key, _ in events) or (pidfd is None and popen.poll() is not None):
+                _drain(collect, standards)
+                return
 
-    standards = (
-        (1, popen.stdout, sys.stdout, lambda _: _),
-        (2, popen.stderr, sys.stderr, _unprefix),
-    )
-    while popen.poll() is None:
-        busy = False
-        for fno, pipe, std, formater in standards:
-            recv = _read(pipe)
-            if not recv:
-                continue
+            for key, _ in events:
+                data = os.read(key.fd, 65536)
+                collect.feed(standards[key.fd], data)
+                if not data:
+                    selector.unregister(key.fd)
+                    del standards[key.fd]
 
-            busy = True
-            short = formater(recv)
-            if not short:
-                continue
 
-            log.answer(short)
-            result[fno] += short
-            if verbose:
-                std.write(short)
+def _report(popen, verbose, timeout=0, limit=0, spill=''):
+    collect = _Collect(verbose, limit, spill)
+    # the pipes still open, and which output they are
+    standards = {
+        popen.stdout.fileno(): 1,
+        popen.stderr.fileno(): 2,
+    }
 
-        if not busy:
-            time.sleep(0.1)
+    pidfd = _exited(popen)
+    try:
+        _select(popen, collect, standards, pidfd, timeout)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+        out, err, sizes = collect.close()
 
-    _blocking(popen.stdout)
-    _blocking(popen.stderr)
+    popen.wait()
+    return out, err, sizes
 
-    return result.values()
+
+# asyncio is only imported by the async functions, it is slow to import
+# and most commands never use it
+
+
+async def _aexited(process):
+    # process.wait() also waits for the pipes to be closed, which a child of
+    # the command (like a ControlPersist ssh master) can keep open long after
+    import asyncio
+
+    pidfd = _exited(process)
+    if pidfd is not None:
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+
+    # the child watcher sets the return code as soon as it notices the exit
+    while process.returncode is None:
+        await asyncio.sleep(0.01)
+
+
+async def _areport(process, verbose, timeout=0, limit=0, spill=''):
+    import asyncio
+
+    collect = _Collect(verbose, limit, spill)
+
+    async def _pump(fno, stream):
+        while True:
+            data = await stream.read(65536)
+            collect.feed(fno, data)
+            if not data:
+                break
+
+    pumps = [asyncio.ensure_future(_pump(1, process.stdout)), asyncio.ensure_future(_pump(2, process.stderr))]
+    try:
+        await asyncio.wait_for(_aexited(process), timeout if timeout else None)
+        # once the process is gone, only what is already buffered is collected
+        await asyncio.wait(pumps, timeout=0.1)
+    except asyncio.TimeoutError:
+        process.kill()
+        await _aexited(process)
+        log.answer(f'killed after {timeout} seconds')
+        raise TimeoutExpired('', timeout)
+    finally:
+        if not all(pump.done() for pump in pumps) and getattr(process, '_transport', None):
+            # the pipes are still kept open by a child, we are done with them
+            process._transport.close()
+        for pump in pumps:
+            pump.cancel()
+        out, err, sizes = collect.close()
+
+    return out, err, sizes
 
 
 def _check(code, exitonfail=True, verbose=True):
@@ -70,31 +200,36 @@ def _check(code, exitonfail=True, verbose=True):
         log.failed('could not complete action requested', verbose=verbose)
 
 
-def chain(cmd1, cmd2, dry, verbose, ignore=''):
+def chain(cmd1, cmd2, dry, verbose, ignore='', hide='', exitonfail=True, limit=0, spill='', where=''):
     command = f'{cmd1} | {cmd2}'
-    log.command(command)
+    secret = command.replace(hide, '********') if hide else command
+    record = log.command(secret, where)
     if dry or verbose:
-        print(command)
+        print(secret)
     if dry:
-        return ''
+        log.ended(record, 0)
+        return 0 if exitonfail else 1
 
-    popen1 = Popen(cmd1, stdout=PIPE, stderr=DEVNULL, shell=True)
-    popen2 = Popen(cmd2, stdin=popen1.stdout, stdout=PIPE, stderr=PIPE, shell=True)
+    popen1, popen2 = transport().pipe(cmd1, cmd2)
     # run copopen2.communicate() before popen1.communicate()
     # otherwise there will be no data on the pipe!
     # as popen1.communicate will have taken it.
-    _report(popen2, verbose)
+    _, _, sizes = _report(popen2, verbose, limit=limit, spill=spill)
     com1 = popen1.communicate()  # noqa: F841
-    _check(popen1.returncode, verbose=verbose)
-    _check(popen2.returncode, verbose=verbose)
+    code = popen1.returncode or popen2.returncode
+    log.ended(record, code, sizes[1], sizes[2])
+    _check(popen1.returncode, exitonfail, verbose=verbose)
+    _check(popen2.returncode, exitonfail, verbose=verbose)
+    return code
 
 
-def run(cmd, dry, verbose, ignore='', hide='', exitonfail=True):
+def run(cmd, dry, verbose, ignore='', hide='', exitonfail=True, timeout=0, limit=0, spill='', where=''):
     command = f'{cmd}'
     secret = command.replace(hide, '********') if hide else command
-    log.command(secret)
+    record = log.command(secret, where)
 
     if dry:
+        log.ended(record, 0)
         print(secret)
         if exitonfail:
             return '', '', 0
@@ -102,9 +237,61 @@ def run(cmd, dry, verbose, ignore='', hide='', exitonfail=True):
     elif verbose:
         print(secret)
 
-    popen = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-    out, err = _report(popen, verbose)
+    popen = transport().spawn(cmd)
+    try:
+        out, err, sizes = _report(popen, verbose, timeout, limit, spill)
+    except TimeoutExpired:
+        log.ended(record, popen.returncode)
+        raise
     code = popen.returncode
+    log.ended(record, code, sizes[1], sizes[2])
+    _check(code, exitonfail, verbose=verbose)
+    return out, err, code
+
+
+async def achain(cmd1, cmd2, dry, verbose, ignore='', hide='', exitonfail=True, limit=0, spill='', where=''):
+    command = f'{cmd1} | {cmd2}'
+    secret = command.replace(hide, '********') if hide else command
+    record = log.command(secret, where)
+    if dry or verbose:
+        print(secret)
+    if dry:
+        log.ended(record, 0)
+        return 0 if exitonfail else 1
+
+    process1, process2 = await transport().apipe(cmd1, cmd2)
+
+    _, _, sizes = await _areport(process2, verbose, limit=limit, spill=spill)
+    await process1.wait()
+    code = process1.returncode or process2.returncode
+    log.ended(record, code, sizes[1], sizes[2])
+    _check(process1.returncode, exitonfail, verbose=verbose)
+    _check(process2.returncode, exitonfail, verbose=verbose)
+    return code
+
+
+async def arun(cmd, dry, verbose, ignore='', hide='', exitonfail=True, timeout=0, limit=0, spill='', where=''):
+    command = f'{cmd}'
+    secret = command.replace(hide, '********') if hide else command
+    record = log.command(secret, where)
+
+    if dry:
+        log.ended(record, 0)
+        print(secret)
+        if exitonfail:
+            return '', '', 0
+        return '', '', 1
+    elif verbose:
+        print(secret)
+
+    process = await transport().aspawn(cmd)
+    try:
+        out, err, sizes = await _areport(process, verbose, timeout, limit, spill)
+    except TimeoutExpired:
+        log.ended(record, process.returncode)
+        raise
+    code = process.returncode
+    log.ended(record, code, sizes[1], sizes[2])
     _check(code, exitonfail, verbose=verbose)
     return out, err, code
 
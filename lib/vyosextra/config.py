@@ -1,4 +1,8 @@
 import os
+import atexit
+import shutil
+import tempfile
+import subprocess
 import configparser
 
 from os.path import join
@@ -14,11 +18,21 @@ class _Config(object):
     __default = {
         'global': {
             'store': '/tmp',
+            'logs': '/tmp',
+            'journal': '~/.cache/vyos-extra/journal.jsonl',
+            'rotate': '16',
             'email': 'no-one@no-domain.com',
             'github': '',
             'editor': 'vi',
             'cloning_dir': '~/.config/vyos/clone',
             'working_dir': '~/vyos',
+            'persist': '60',
+            'connections': '4',
+            'ttl': '3600',
+            'store_capacity': '2048',
+            'transport': 'local',
+            'latency': '0.05',
+            'output': '4096',
         },
         'machine': {
             'role': 'router',
@@ -27,7 +41,13 @@ class _Config(object):
             'user': 'vyos',
             'file': '',
             'repo': '$HOME/vyos/vyos-build',
+            'cache': '$HOME/vyos/cache',
+            'retention': '14',
+            'capacity': '4096',
             'default': 'False',
+            'multiplex': 'True',
+            'transfer': 'auto',
+            'tags': '',
         },
     }
 
@@ -45,6 +65,7 @@ class _Config(object):
 
     __instance = None
     _values = {}
+    _sockets = ''
     default = {}
 
     # This class is a singleton
@@ -60,10 +81,23 @@ class _Config(object):
             'port': lambda port: int(port),
             'file': self.absolute_path,
             'store': self.absolute_path,
+            'logs': self.absolute_path,
+            'journal': lambda journal: self.absolute_path(journal) if journal else '',
             'editor': self.absolute_path,
             'cloning_dir': self.absolute_path,
             'working_dir': self.absolute_path,
             'default': self.boolean,
+            'multiplex': self.boolean,
+            'persist': lambda persist: int(persist),
+            'connections': lambda connections: int(connections),
+            'ttl': lambda ttl: int(ttl),
+            'rotate': lambda rotate: int(rotate),
+            'latency': lambda latency: float(latency),
+            'output': lambda output: int(output),
+            'retention': lambda retention: int(retention),
+            'capacity': lambda capacity: int(capacity),
+            'store_capacity': lambda capacity: int(capacity),
+            'tags': lambda tags: [_.strip() for _ in tags.split(',') if _.strip()],
         }
 
         self._read_config()
@@ -71,6 +105,8 @@ class _Config(object):
         self._add_default()
         self._add_role()
 
+        log.journal(self.get('global', 'journal'), self.get('global', 'rotate'))
+
     def _default(self, section, key=None):
         default = self.__default.get(section, {})
         if not default:
@@ -80,6 +116,10 @@ class _Config(object):
         return default[key]
 
     def _conf_file(self, name):
+        # an explicit configuration file, used by ./benchmark for its fake machines
+        if os.environ.get('VYOSEXTRA_CONFIG', ''):
+            return self.absolute_path(os.environ['VYOSEXTRA_CONFIG'])
+
         folder_name = name.replace('-', '/')
         etcs = [
             self.absolute_path(f'~/.config/{folder_name}'),
@@ -151,6 +191,26 @@ class _Config(object):
     def exists(self, machine):
         return machine in self._values
 
+    def _members(self, name):
+        # name is a machine, or a role or tag shared by several machines
+        if self.exists(name):
+            return [name]
+        return sorted(
+            machine
+            for machine, values in self._values.items()
+            if machine != 'global' and (values.get('role', '') == name or name in values.get('tags', []))
+        )
+
+    def group(self, names):
+        machines = []
+        for name in names:
+            machines.extend(machine for machine in self._members(name) if machine not in machines)
+        return machines
+
+    def unknown(self, names):
+        # the names matching no machine, role or tag
+        return [name for name in names if not self._members(name)]
+
     def get(self, section, key):
         return self._values.setdefault(section, {}).get(key, '')
 
@@ -164,7 +224,34 @@ class _Config(object):
     def printf(self, string):
         return 'printf "' + string.replace('\n', '\\n').replace('"', '\"') + '"'
 
-    def ssh(self, where, command='', extra='', su=False, quote=True):
+    def multiplex(self, where):
+        # share one ssh connection (ControlMaster) per machine for the
+        # lifetime of this program, instead of a new handshake per command
+        if not self._values[where]['multiplex']:
+            return ''
+
+        if not self._sockets:
+            self._sockets = tempfile.mkdtemp(prefix='vyos-')
+            atexit.register(self._demultiplex)
+
+        persist = self.get('global', 'persist')
+        return f'-o ControlMaster=auto -o ControlPath={self._sockets}/%C -o ControlPersist={persist}'
+
+    def _demultiplex(self):
+        if not self._sockets:
+            return
+
+        for socket in os.listdir(self._sockets):
+            path = join(self._sockets, socket)
+            subprocess.run(
+                ['ssh', '-O', 'exit', '-o', f'ControlPath={path}', 'multiplexed'],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        shutil.rmtree(self._sockets, ignore_errors=True)
+        self._sockets = ''
+
+    def ssh(self, where, command='', extra='', su=False, quote=True, multiplex=True):
         host = self._values[where]['host']
         user = self._values[where]['user']
         port = self._values[where]['port']
@@ -180,6 +267,9 @@ class _Config(object):
                 return f'sudo su - -c "{command}"'
             return command
 
+        if multiplex:
+            extra += f' {self.multiplex(where)}'
+
         command = command.replace('$', '\$')  # noqa: W605
         if ' ' in command and quote:
             command = command.replace('"', '\\\\"')
@@ -187,7 +277,7 @@ class _Config(object):
 
         return f'ssh {extra} -p {port} {user}@{host} {command}'
 
-    def scp(self, where, src, dst):
+    def scp(self, where, src, dst, extra='', multiplex=True):
         host = self._values[where]['host']
         user = self._values[where]['user']
         port = self._values[where]['port']
@@ -195,19 +285,22 @@ class _Config(object):
         if role == 'build' and host in ('localhost', '127.0.0.1', '::1') and port == 22:
             return f'scp -r {src} {dst}'
         dst = dst.replace('$', '\$')  # noqa: W605
-        return f'scp -r -P {port} {src} {user}@{host}:{dst}'
+
+        if multiplex:
+            extra += f' {self.multiplex(where)}'
+        return f'scp -r {extra} -P {port} {src} {user}@{host}:{dst}'
 
     def docker(self, where, release, rwd, command):
         # rwd: relative working directory
         repo = self._values[where]['repo']
         return f'docker run --rm --privileged -v {repo}:{repo} -w {repo}/{rwd} vyos/vyos-build:{release} {command}'  # noqa: E501
 
-    def rsync(self, where, src, dest, exclude=''):
+    def rsync(self, where, src, dest, exclude='', options=''):
         host = self._values[where]['host']
         user = self._values[where]['user']
         port = self._values[where]['port']
 
-        options = '-avh --delete'
+        options = f'-avh --delete {options}'.strip()
         if exclude:
             options += f" --exclude '{exclude}'"
 
@@ -216,11 +309,31 @@ class _Config(object):
 
         dest = dest.replace('$', '\$')  # noqa: W605
 
+        extra = self.multiplex(where)
         file = self._values[where]['file']
         if file:
-            file = f' -i {file}'
-        return f'rsync {options} -e "ssh -p {port}{file}" {src} {user}@{host}:{dest}'
+            extra += f' -i {file}'
+        return f'rsync {options} -e "ssh -p {port} {extra}" {src} {user}@{host}:{dest}'
+
+
+class _Lazy(object):
+    # the configuration is only read (files and environment) when first used,
+    # commands which do not need it do not pay for it
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_instance', None)
+
+    def _load(self):
+        if self._instance is None:
+            object.__setattr__(self, '_instance', self._factory())
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
 
 
 # The global configuration
-config = _Config()
+config = _Lazy(_Config)
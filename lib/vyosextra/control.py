@@ -1,5 +1,8 @@
+import os
+
 from vyosextra.config import config
 from vyosextra import command
+from vyosextra import log
 
 
 class Control(object):
@@ -9,6 +12,9 @@ class Control(object):
         ('src/op_mode/*', '/usr/libexec/vyos/op_mode/'),
     ]
 
+    # how much of the output of long running commands is kept in memory
+    tail = 64 * 1024
+
     def __init__(self, dry, verbose):
         self.dry = dry
         self.verbose = verbose
@@ -19,7 +25,9 @@ class Control(object):
     def chain(self, cmd1, cmd2, **kargs):
         return command.chain(cmd1, cmd2, self.dry, self.verbose, **kargs)
 
-    def ssh(self, where, cmd, ignore='', extra='', hide='', su=False, exitonfail=True, quote=True):
+    def ssh(
+        self, where, cmd, ignore='', extra='', hide='', su=False, exitonfail=True, quote=True, timeout=0, limit=0, spill=''
+    ):
         return command.run(
             config.ssh(where, cmd, extra=extra, su=su, quote=quote),
             self.dry,
@@ -27,15 +35,45 @@ class Control(object):
             ignore=ignore,
             hide=hide,
             exitonfail=exitonfail,
+            timeout=timeout,
+            limit=limit,
+            spill=spill,
+            where=where,
         )
 
     def scp(self, where, src, dst):
-        return command.run(config.scp(where, src, dst), self.dry, self.verbose)
+        return command.run(config.scp(where, src, dst), self.dry, self.verbose, where=where)
+
+    # awaitable versions of run, chain, ssh and scp, so that independent
+    # commands can be run at the same time (with asyncio.gather, ...)
+
+    async def arun(self, cmd, **kargs):
+        return await command.arun(cmd, self.dry, self.verbose, **kargs)
+
+    async def achain(self, cmd1, cmd2, **kargs):
+        return await command.achain(cmd1, cmd2, self.dry, self.verbose, **kargs)
+
+    async def assh(self, where, cmd, extra='', su=False, quote=True, **kargs):
+        return await command.arun(
+            config.ssh(where, cmd, extra=extra, su=su, quote=quote), self.dry, self.verbose, where=where, **kargs
+        )
+
+    async def ascp(self, where, src, dst):
+        return await command.arun(config.scp(where, src, dst), self.dry, self.verbose, where=where)
+
+    def spill(self, name):
+        # the file where the full output of a long running command is saved
+        fname = os.path.join(config.get('global', 'logs'), f'vyos-extra-{name}.log')
+        if not self.dry:
+            open(fname, 'w').close()
+        return fname
 
     def git(self, where, action):
         build_repo = config.get(where, 'repo')
-        self.ssh(where, f'cd {build_repo} && git {action}', 'Already up')
+        with log.phase(f'git {action}', where):
+            self.ssh(where, f'cd {build_repo} && git {action}', 'Already up')
 
     def docker_pull(self, where, release):
-        self.ssh(where, f'docker pull vyos/vyos-build:{release}', su=True)
-        self.ssh(where, f'docker image prune -f', su=True)
+        with log.phase('docker pull', where):
+            self.ssh(where, f'docker pull vyos/vyos-build:{release}', su=True)
+            self.ssh(where, f'docker image prune -f', su=True)
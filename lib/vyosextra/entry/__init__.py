@@ -1,26 +1,100 @@
 #!/usr/bin/env python3
 
+import os
 import sys
-import pkgutil
+import json
 import importlib
 
 from vyosextra.register import Registerer
 
 
-def import_all(package_name):
-    package = sys.modules[package_name]
-    return {
-        name: importlib.import_module(package_name + '.' + name)
-        for loader, name, is_pkg in pkgutil.walk_packages(package.__path__)
-    }
+# the name and help of every entry point, so that no entry module has
+# to be imported before one of them is called, kept next to the bytecode
+if sys.pycache_prefix:
+    MANIFEST = os.path.join(sys.pycache_prefix, os.path.dirname(os.path.abspath(__file__)).lstrip(os.sep), 'manifest.json')
+else:
+    MANIFEST = os.path.join(os.path.dirname(__file__), '__pycache__', 'manifest.json')
 
 
-__MODULES = import_all(__name__)
-__all__ = __MODULES.keys()
+def _docstring(fname):
+    # the docstring of the main function of a module, without importing it
+    import ast
+
+    with open(fname) as f:
+        tree = ast.parse(f.read(), fname)
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == 'main':
+            return ast.get_docstring(node) or ''
+    return ''
+
+
+def _modules(package_path):
+    # what pkgutil.iter_modules finds, without its import of inspect
+    for folder in package_path:
+        if not os.path.isdir(folder):
+            # within a zipapp (see ./release), pkgutil can look in the archive
+            import pkgutil
+
+            for module in pkgutil.iter_modules([folder]):
+                yield module.name, ''
+            continue
+        for entry in sorted(os.scandir(folder), key=lambda _: _.name):
+            if entry.name.endswith('.py') and not entry.name.startswith('_'):
+                yield entry.name[:-3], entry.path
+
+
+def _load():
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store(entries):
+    try:
+        os.makedirs(os.path.dirname(MANIFEST), exist_ok=True)
+        with open(MANIFEST, 'w') as f:
+            json.dump(entries, f)
+    except OSError:
+        # a read-only installation only pays the parsing
+        pass
+
+
+def _entry(name, fname, cached):
+    # [modification time, doc] of a module, None if it vanished
+    if not fname:
+        # within a zipapp there is nothing to parse or cache, the module has to be imported
+        return [0, importlib.import_module(f'{__name__}.{name}').main.__doc__]
+    try:
+        modified = os.path.getmtime(fname)
+    except OSError:
+        return None
+    when, doc = cached.get(name, [0, ''])
+    return [modified, doc if when == modified else _docstring(fname)]
+
+
+def manifest(package_path):
+    cached = _load()
+
+    entries = {}
+    for name, fname in _modules(package_path):
+        entry = _entry(name, fname, cached)
+        if entry is not None:
+            entries[name] = entry
+
+    if entries != cached:
+        _store(entries)
+
+    return {name: doc for name, (_, doc) in entries.items()}
+
+
+__MODULES = manifest(__path__)
+__all__ = list(__MODULES)
 
 
 # register the entry points in the module
 
 register = Registerer()
-for name, module in __MODULES.items():
-    register(name, module.main)
+for name, doc in __MODULES.items():
+    register.lazy(name, f'{__name__}.{name}', doc)
@@ -3,6 +3,9 @@
 
 import os
 import sys
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from vyosextra import log
 from vyosextra import control
@@ -14,12 +17,80 @@ from vyosextra.config import config
 class Control(control.Control):
     location = 'compiled'
 
-    def cleanup(self, where):
+    @log.phase('cleanup')
+    def cleanup(self, where, vyos_repos, clean=False):
         build_repo = config.get(where, 'repo')
+        workspace = f'{build_repo}/{self.location}'
 
-        self.ssh(where, f"rm -rf {build_repo}/{self.location}/*", exitonfail=False)
+        if clean:
+            self.ssh(where, f"rm -rf {workspace}/*", exitonfail=False)
+            return
 
-    def build(self, where, vyos_repo, release, folder):
+        # keep the source mirrors, so rsync only transfers what changed,
+        # but remove the packages about to be rebuilt and anything unused
+        retention = config.get(where, 'retention')
+        stale = ' '.join(f'{workspace}/{vyos_repo}_*' for vyos_repo in vyos_repos)
+        self.ssh(where, f'rm -f {stale}', exitonfail=False)
+        self.ssh(where, f'find {workspace} -mindepth 1 -maxdepth 1 -mtime +{retention} -exec rm -rf {{}} +', exitonfail=False)
+        self.evict(where)
+
+    def evict(self, where):
+        # remove the least recently used cached packages above the capacity
+        cache = config.get(where, 'cache')
+        retention = config.get(where, 'retention')
+        capacity = config.get(where, 'capacity') * 1024
+
+        self.ssh(where, f'find {cache} -mindepth 1 -maxdepth 1 -mtime +{retention} -exec rm -rf {{}} +', exitonfail=False)
+        out, _, _ = self.ssh(where, f'du -sk --time {cache}/* 2>/dev/null', exitonfail=False)
+
+        entries = []
+        for line in out.split('\n'):
+            parts = line.split('\t')
+            if len(parts) != 3 or not parts[0].isdigit():
+                continue
+            size, when, path = parts
+            entries.append((when, int(size), path))
+
+        used = sum(size for _, size, _ in entries)
+        evicted = []
+        for when, size, path in sorted(entries):
+            if used <= capacity:
+                break
+            used -= size
+            evicted.append(path)
+
+        if evicted:
+            self.ssh(where, f'rm -rf {" ".join(evicted)}', exitonfail=False)
+
+    def digest(self, where, release):
+        # the docker image used for the build is part of the cache key
+        image = f'vyos/vyos-build:{release}'
+        out, _, _ = self.ssh(where, f"docker image inspect --format '{{{{.Id}}}}' {image}", exitonfail=False)
+        return out.strip()
+
+    def restore(self, where, package, key):
+        build_repo = config.get(where, 'repo')
+        cache = config.get(where, 'cache')
+
+        _, _, code = self.ssh(where, f'test -f {cache}/{key}/{package}', exitonfail=False)
+        if code:
+            return False
+
+        # touched, so the cache eviction can use the last use time
+        self.ssh(where, f'touch {cache}/{key} && cp {cache}/{key}/* {build_repo}/{self.location}/')
+        return True
+
+    def store(self, where, vyos_repo, key):
+        # every artifact of the build (packages, .buildinfo, .changes) is kept
+        build_repo = config.get(where, 'repo')
+        cache = config.get(where, 'cache')
+
+        artifacts = f'{build_repo}/{self.location}/{vyos_repo}_*'
+        self.ssh(where, f'mkdir -p {cache}/{key} && cp {artifacts} {cache}/{key}/', exitonfail=False)
+
+    def prepare(self, where, vyos_repo, release, digest, folder, cached=True):
+        # returns the package name, the cache key ('' if it can not be cached)
+        # and if the package was restored from the cache
         build_repo = config.get(where, 'repo')
         self.ssh(where, f'mkdir -p {build_repo}/{self.location}/{vyos_repo}')
 
@@ -27,27 +98,196 @@ class Control(control.Control):
             package = debian.package(vyos_repo)
             if not package:
                 log.failed(f'could not find {vyos_repo} package version', verbose=self.verbose)
-            elif not self.dry:
+
+            # identical sources, release and build image give an identical package,
+            # without a git tree there is nothing to identify the sources with
+            tree = debian.tree()
+            key = ''
+            if cached and tree:
+                key = hashlib.sha256(f'{tree} {release} {digest}'.encode()).hexdigest()[:32]
+                key = f'{vyos_repo}-{key}'
+
+            if key and self.restore(where, package, key):
+                if not self.dry:
+                    log.note(f'using cached package {package}')
+                return package, key, True
+
+            if not self.dry:
                 log.note(f'building package {package}')
+            with log.phase(f'rsync {vyos_repo}', where):
+                self.run(config.rsync(where, '.', f'{build_repo}/{self.location}/{vyos_repo}'), limit=self.tail, where=where)
+                # rsync copies the folder time, mark the mirror as recently used
+                self.ssh(where, f'touch {build_repo}/{self.location}/{vyos_repo}')
+
+        return package, key, False
+
+    async def compile(self, where, vyos_repo, release):
+        spill = self.spill(f'build-{vyos_repo}')
+        if not self.dry:
+            log.note(f'the output of the {vyos_repo} build is saved in {spill}')
+
+        # each build runs in its own (--rm) docker container
+        dpkg = config.docker(where, release, f'{self.location}/{vyos_repo}', 'dpkg-buildpackage -uc -us -tc -b')
+        with log.phase(f'dpkg-buildpackage {vyos_repo}', where):
+            _, _, code = await self.assh(where, dpkg, exitonfail=False, limit=self.tail, spill=spill)
+        return code, spill
+
+    def build(self, where, vyos_repo, release, folder, cached=True):
+        return self.build_all(where, [vyos_repo], release, folder, 1, cached)
+
+    def build_all(self, where, vyos_repos, release, folder, jobs, cached=True):
+        digest = self.digest(where, release) if cached else ''
+
+        # sources are transferred one after the other (Repository changes
+        # the working directory) but the packages are compiled concurrently
+        prepared = {}
+        for vyos_repo in vyos_repos:
+            prepared[vyos_repo] = self.prepare(where, vyos_repo, release, digest, folder, cached)
+        compiling = [vyos_repo for vyos_repo in vyos_repos if not prepared[vyos_repo][2]]
+
+        # the output of concurrent builds can not be streamed, only saved
+        concurrent = min(len(compiling), max(jobs, 1))
+        builder = self if concurrent <= 1 else type(self)(self.dry, False)
+
+        async def _compile(semaphore, vyos_repo):
+            async with semaphore:
+                if concurrent > 1:
+                    print(f'building {vyos_repo}')
+                return await builder.compile(where, vyos_repo, release)
 
-            self.run(config.rsync(where, '.', f'{build_repo}/{self.location}/{vyos_repo}'))
-            self.ssh(where, config.docker(where, release, f'{self.location}/{vyos_repo}', 'dpkg-buildpackage -uc -us -tc -b'))
+        async def _compile_all():
+            # created in the loop of asyncio.run, python < 3.10 binds it to the current loop
+            semaphore = asyncio.Semaphore(max(concurrent, 1))
+            return await asyncio.gather(*[_compile(semaphore, vyos_repo) for vyos_repo in compiling])
 
+        results = dict(zip(compiling, asyncio.run(_compile_all())))
+
+        failed = self.collect(where, vyos_repos, prepared, results)
+        if failed:
+            log.failed(f'could not build {", ".join(failed)}', verbose=self.verbose)
         return True
 
-    def install(self, server, router, vyos_repo, location):
-        build_repo = config.get(server, 'repo')
+    def collect(self, where, vyos_repos, prepared, results):
+        # cache what was built, returning what failed to build
+        failed = []
+        for vyos_repo in vyos_repos:
+            _, key, _ = prepared[vyos_repo]
+            if vyos_repo not in results:
+                state, spill = 'cached', ''
+            else:
+                code, spill = results[vyos_repo]
+                # in dry mode, commands which may fail report a failure
+                state = 'failed' if code and not self.dry else 'built'
+
+            if state == 'failed':
+                failed.append(vyos_repo)
+            elif state == 'built' and key:
+                self.store(where, vyos_repo, key)
+
+            if len(vyos_repos) > 1:
+                print(f'{vyos_repo:<20} {state:<6} {spill}')
+        return failed
+
+    def transfer(self, server, router, source, package):
+        # the build server sends the file straight to the router (using our
+        # ssh agent) and only if it can not, it is relayed through us;
+        # returns why the transfer failed, empty if it worked
+        mode = config.get(router, 'transfer')
+
+        out, _, code = self.ssh(server, f'sha256sum {source}', exitonfail=False)
+        if code and not self.dry:
+            return f'could not find {source} on {server}'
+        checksum = out.split(' ')[0]
 
+        sent = False
+        if mode in ('auto', 'direct'):
+            # the host key policy of the build server applies, an unknown router is relayed
+            push = config.scp(router, source, package, extra='-o BatchMode=yes', multiplex=False)
+            _, _, code = self.ssh(server, push, extra='-A', exitonfail=False)
+            sent = code == 0
+            if not sent and mode == 'direct' and not self.dry:
+                return f'{server} could not send {package} to {router}'
+
+        if not sent:
+            send = config.ssh(server, f'gzip -1 -c {source}')
+            receive = config.ssh(router, f'gunzip -c - > {package}')
+            code = self.chain(send, receive, exitonfail=False, where=router)
+            if code and not self.dry:
+                return f'could not relay {package} to {router}'
+
+        out, _, code = self.ssh(router, f'sha256sum {package}', exitonfail=False)
+        if not self.dry and (code or out.split(' ')[0] != checksum):
+            return f'the checksum of {package} changed during the transfer'
+        return ''
+
+    def package(self, vyos_repo, location):
         with Repository(os.path.join(location, vyos_repo), verbose=self.verbose) as debian:
             package = debian.package(vyos_repo)
             if not package:
                 log.failed(f'could not find {vyos_repo} package name')
-            if not self.dry:
-                log.note(f'installing {package}')
+        return package
+
+    def deliver(self, server, router, package):
+        # returns why the installation failed, empty if it worked, so that
+        # concurrent installations do not exit (log.failed) from their thread
+        build_repo = config.get(server, 'repo')
 
-        self.chain(config.ssh(server, f'cat {build_repo}/{self.location}/{package}'), config.ssh(router, f'cat - > {package}'))
-        self.ssh(router, f'sudo dpkg -i --force-all {package}')
-        self.ssh(router, f'rm {package}')
+        if not self.dry:
+            log.note(f'installing {package} on {router}')
+
+        with log.phase(f'transfer {package}', router):
+            error = self.transfer(server, router, f'{build_repo}/{self.location}/{package}', package)
+        if error:
+            return error
+
+        with log.phase(f'dpkg -i {package}', router):
+            _, _, code = self.ssh(router, f'sudo dpkg -i --force-all {package}', exitonfail=False)
+            self.ssh(router, f'rm {package}', exitonfail=False)
+        if code and not self.dry:
+            return f'dpkg could not install {package}'
+        return ''
+
+    def install(self, server, router, vyos_repo, location):
+        error = self.deliver(server, router, self.package(vyos_repo, location))
+        if error:
+            log.failed(f'could not install on {router}: {error}', verbose=self.verbose)
+
+    def deliver_all(self, server, router, packages):
+        # the reason the installation on router failed, empty if it worked
+        try:
+            for package in packages:
+                error = self.deliver(server, router, package)
+                if error:
+                    return error
+            return ''
+        except Exception as exc:
+            return str(exc)
+
+    def install_all(self, server, routers, vyos_repos, location, jobs):
+        # installed in the order given, so dependencies can be listed first
+        packages = [self.package(vyos_repo, location) for vyos_repo in vyos_repos]
+
+        if len(routers) == 1:
+            error = self.deliver_all(server, routers[0], packages)
+            if error:
+                log.failed(f'could not install on {routers[0]}: {error}', verbose=self.verbose)
+            return
+
+        # the output of concurrent installations can not be streamed, and the
+        # errors are only reported once all of them are done
+        installer = type(self)(self.dry, False)
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = [executor.submit(installer.deliver_all, server, router, packages) for router in routers]
+            results = [future.result() for future in futures]
+
+        failed = []
+        for router, error in zip(routers, results):
+            print(f'{router:<20} {"failed: " + error if error else "installed"}')
+            if error:
+                failed.append(router)
+
+        if failed:
+            log.failed(f'could not install on {", ".join(failed)}', verbose=self.verbose)
 
 
 def main():
@@ -58,24 +298,28 @@ def main():
     if not config.exists(arg.server):
         sys.exit(f'machine "{arg.server}" is not configured\n')
 
-    if not config.exists(arg.router):
-        sys.exit(f'machine "{arg.router}" is not configured\n')
-
     role = config.get(arg.server, 'role')
     if role != 'build':
         sys.exit(f'target "{arg.server}" is not a build machine\n')
 
-    role = config.get(arg.router, 'role')
-    if role != 'router':
-        sys.exit(f'target "{arg.router}" is not a VyOS router\n')
+    # before any work starts, so a mistyped name does not go unnoticed
+    unknown = config.unknown(arg.router)
+    if unknown:
+        sys.exit(f'no machine or group "{" ".join(unknown)}" is configured\n')
+
+    routers = config.group(arg.router)
+
+    for router in routers:
+        role = config.get(router, 'role')
+        if role != 'router':
+            sys.exit(f'target "{router}" is not a VyOS router\n')
 
     control.git(arg.server, f'checkout current')
     control.git(arg.server, f'pull')
-    control.cleanup(arg.server)
+    control.cleanup(arg.server, arg.packages, arg.clean)
 
-    for package in arg.packages:
-        control.build(arg.server, package, 'current', arg.working)
-        control.install(arg.server, arg.router, package, arg.working)
+    control.build_all(arg.server, arg.packages, 'current', arg.working, arg.jobs, not arg.rebuild)
+    control.install_all(arg.server, routers, arg.packages, arg.working, arg.jobs)
     log.completed('package(s) installed')
 
 if __name__ == '__main__':
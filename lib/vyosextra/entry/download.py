@@ -8,17 +8,17 @@ import time
 import datetime
 import urllib.request
 
+from vyosextra import log
+from vyosextra import fetcher
 from vyosextra import arguments
+from vyosextra.store import Store
 from vyosextra.config import config
 
 
 regex_rolling = '(vyos-1.3-rolling-[0-9]+-amd64.iso)'
 
 
-def latest(filename):
-    if filename:
-        return filename.split('/')[-1]
-
+def listing():
     vyos_listing = "https://downloads.vyos.io/?dir=rolling/current/amd64"
     regex = re.compile(f'data-name="{regex_rolling}"')
 
@@ -33,8 +33,21 @@ def latest(filename):
         found.sort()
         return found[-1]
     except Exception:
-        # should not happen, but something is better than nothing
-        return 'vyos-rolling-latest.iso'
+        return ''
+
+
+def latest(filename):
+    if filename:
+        return filename.split('/')[-1]
+
+    # the listing is only looked at again once the cached answer expired
+    store = Store(config.get('global', 'store'))
+    found = store.latest(config.get('global', 'ttl'), listing)
+    if found:
+        return found
+
+    # should not happen, but something is better than nothing
+    return 'vyos-rolling-latest.iso'
 
 
 def makeup(target):
@@ -52,11 +65,16 @@ def makeup(target):
     return image, location, url
 
 
-def fetch(target='', show=False):
+@log.phase('download')
+def fetch(target='', show=False, checksum=''):
     image, location, url = makeup(target)
+    store = Store(config.get('global', 'store'))
+    stored = os.path.dirname(location) == store.folder
 
     if os.path.exists(location):
         print(f'already downloaded iso file {image}')
+        if stored and not show:
+            store.use(location)
         return location
 
     print(f'downloading {url}')
@@ -71,12 +89,11 @@ def fetch(target='', show=False):
 
     start_time = time.time()
 
-    def hook(count, block_size, total_size):
+    def hook(progress, total_size):
         duration = time.time() - start_time
         elapsed = str(datetime.timedelta(seconds=duration)).split('.')[0]
-        progress = int(count * block_size)
         speed = int(progress / (1024 * (int(duration) + 1)))
-        percent = min(int(count * block_size * 100 / total_size), 100)
+        percent = min(int(progress * 100 / total_size), 100) if total_size else 0
         progress_mb = progress / (1024 * 1024)
         # fmt: off
         report = (f'   {image} {percent:>3}%,'
@@ -88,26 +105,45 @@ def fetch(target='', show=False):
         sys.stdout.flush()
 
     try:
-        urllib.request.urlretrieve(url, location, hook)
+        fetcher.download(url, location, config.get('global', 'connections'), hook)
         print('\ndownload complete')
-        return location
     except KeyboardInterrupt:
         print('\ndownload interrupted')
-        print(f'\nremoving {location}')
-        os.remove(location)
+        print('\nrun the command again to resume it')
         sys.exit(2)
     except Exception as excp:
         print(f'\nissue while downloading {image}')
         print(excp)
+        print('\nrun the command again to resume it')
+        sys.exit(3)
+
+    verify(location, url, checksum)
+
+    if stored:
+        store.add(location)
+        for name in store.prune(config.get('global', 'store_capacity'), keep=image):
+            print(f'removed old image {name}')
+    return location
+
+
+def verify(location, url, checksum=''):
+    expected = checksum.lower() or fetcher.published(url)
+    if not expected:
+        print('no checksum was published for this image, it could not be verified')
+        return
+
+    print('verifying checksum')
+    if fetcher.sha256(location) != expected:
+        print(f'\nthe checksum of {location} is invalid')
         print(f'\nremoving {location}')
         os.remove(location)
-        sys.exit(3)
+        sys.exit(4)
 
 
 def main():
     'download latest VyOS rolling image'
     arg = arguments.setup(__doc__, ['download'])
-    fetch(arg.file)
+    fetch(show=arg.dry, checksum=arg.sha256)
 
 
 if __name__ == '__main__':
@@ -12,10 +12,26 @@ from vyosextra.entry import build as control
 
 
 class Control(control.Control):
-    location = 'packages'  # packages, is used by crux !
+    # the packages are built in the workspace of vyos build, the ISO
+    # includes every package found in the packages folder of vyos-build
+    packages = 'packages'
+
+    def unpublish(self, where):
+        # no package of a previous run, or of another release, in the ISO
+        build_repo = config.get(where, 'repo')
+        self.ssh(where, f'rm -f {build_repo}/{self.packages}/*.deb', exitonfail=False)
+
+    def publish(self, where, vyos_repos):
+        build_repo = config.get(where, 'repo')
+        debs = ' '.join(f'{build_repo}/{self.location}/{vyos_repo}_*.deb' for vyos_repo in vyos_repos)
+        self.ssh(where, f'cp {debs} {build_repo}/{self.packages}/')
 
     def make(self, where, release, target):
-        self.ssh(where, config.docker(where, release, '', f'sudo make {target}'), extra='-t')
+        spill = self.spill(f'make-{target}')
+        if not self.dry:
+            log.note(f'the output of make {target} is saved in {spill}')
+        with log.phase(f'make {target}', where):
+            self.ssh(where, config.docker(where, release, '', f'sudo make {target}'), extra='-t', limit=self.tail, spill=spill)
 
     def backdoor(self, where, password):
         build_repo = config.get(where, 'repo')
@@ -29,7 +45,7 @@ class Control(control.Control):
             return
 
         data = ''.join(lines).format(user='admin', password=password)
-        self.chain(config.printf(data), config.ssh(where, f'cat - > {build_repo}/{location}'))
+        self.chain(config.printf(data), config.ssh(where, f'cat - > {build_repo}/{location}'), hide=password, where=where)
 
     def configure(self, where, release, extra, name):
         email = config.get('global', 'email')
@@ -47,9 +63,11 @@ class Control(control.Control):
         if extra:
             configure += f"  --custom-package '{extra}'"
 
-        self.ssh(where, config.docker(where, release, '', f'git checkout {release}'))
-        self.ssh(where, config.docker(where, release, '', f'./configure {configure}'))
+        with log.phase('configure', where):
+            self.ssh(where, config.docker(where, release, '', f'git checkout {release}'))
+            self.ssh(where, config.docker(where, release, '', f'./configure {configure}'))
 
+    @log.phase('fetch iso')
     def fetch(self, where):
         build_repo = config.get(where, 'repo')
 
@@ -58,7 +76,8 @@ class Control(control.Control):
 
         self.chain(
             config.ssh(where, f'cat {build_repo}/build/live-image-amd64.hybrid.iso'),
-            f'cat - > {iso}'
+            f'cat - > {iso}',
+            where=where,
         )
 
 
@@ -84,8 +103,9 @@ def main(target=''):
     if role != 'build':
         sys.exit(f'target "{arg.server}" is not a build machine')
 
-    control.cleanup(arg.server)
-    # to re-add the vyos-1x folder we deleted
+    control.cleanup(arg.server, arg.packages, arg.clean)
+    control.unpublish(arg.server)
+    # to re-add anything older versions of this tool deleted in packages
     control.git(arg.server, 'checkout packages')
     control.git(arg.server, f'checkout {release}')
     control.git(arg.server, 'pull')
@@ -97,10 +117,10 @@ def main(target=''):
 
     done = False
     if not arg.release:
-        for package in arg.packages:
-            done = control.build(arg.server, package, 'current', arg.working)
+        done = control.build_all(arg.server, arg.packages, 'current', arg.working, arg.jobs, not arg.rebuild)
 
     if done:
+        control.publish(arg.server, arg.packages)
         control.backdoor(arg.server, arg.backdoor)
     if done or arg.release:
         control.configure(arg.server, release, arg.extra, arg.name)
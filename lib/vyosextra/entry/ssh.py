@@ -17,7 +17,7 @@ def main():
     if not config.exists(arg.machine):
         sys.exit(f'machine "{arg.machine}" is not configured\n')
 
-    connect = config.ssh(arg.machine, '')
+    connect = config.ssh(arg.machine, '', multiplex=False)
 
     if arg.dry or arg.quiet:
         print(connect)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import datetime
+
+from vyosextra import log
+from vyosextra import arguments
+from vyosextra.store import Store
+from vyosextra.config import config
+
+
+def show(store):
+    images = store.images()
+    if not images:
+        print(f'no image stored in {store.folder}')
+        return
+
+    for name, entry in images:
+        used = datetime.datetime.fromtimestamp(entry['used']).strftime('%Y-%m-%d %H:%M')
+        size = entry['size'] / (1024 * 1024)
+        print(f'{name:<45} {size:>7.1f} MB  used {used}  {entry["sha256"][:16]}')
+    total = store.used() / (1024 * 1024)
+    print(f'{len(images)} image(s), {total:.1f} MB in {store.folder}')
+
+
+def prune(store, dry):
+    capacity = config.get('global', 'store_capacity')
+    if dry:
+        print(f'would remove the least recently used images above {capacity} MB')
+        return
+
+    removed = store.prune(capacity)
+    for name in removed:
+        print(f'removed {name}')
+    if not removed:
+        print(f'the images already fit in {capacity} MB')
+
+
+def main():
+    'manage the downloaded VyOS images'
+    arg = arguments.setup(__doc__, ['store'])
+    store = Store(config.get('global', 'store'))
+
+    if arg.action == 'list':
+        show(store)
+    elif arg.action == 'prune':
+        prune(store, arg.dry)
+
+    log.completed()
+
+
+if __name__ == '__main__':
+    main()
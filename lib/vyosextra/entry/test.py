@@ -3,11 +3,17 @@
 
 # based on https://github.com/sever-sever/vyos-checks/blob/master/main.yml
 
+import re
 import sys
+import uuid
+import tempfile
+from subprocess import TimeoutExpired
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 
+from vyosextra import control
 from vyosextra import arguments
 from vyosextra.config import config
-from vyosextra.control import Control
 
 
 commands = [
@@ -290,6 +296,97 @@ class color:
     END = '\033[0m'
 
 
+wrapper = '/opt/vyatta/bin/vyatta-op-cmd-wrapper'
+
+
+class Control(control.Control):
+    def show(self, where, command, timeout):
+        show = f'{wrapper} {command}'
+        try:
+            out, err, _ = self.ssh(where, show, exitonfail=False, timeout=timeout)
+        except TimeoutExpired:
+            return '', '', f'no answer after {timeout} seconds'
+        return out, err, ''
+
+    def sweep(self, where, commands, jobs, timeout):
+        # the results are returned in the order of the commands,
+        # whatever the order in which the router answered them
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            # let the first command open the shared ssh connection
+            # so all the others can reuse it
+            first = executor.submit(self.show, where, commands[0], timeout)
+            first.result()
+
+            futures = [first] + [executor.submit(self.show, where, command, timeout) for command in commands[1:]]
+            for command, future in zip(commands, futures):
+                yield command, future
+
+    def script(self, commands, boundary, timeout):
+        # each command output is framed by boundary lines:
+        # <boundary> <index> out|err|code [exit code]
+        lines = ['err=$(mktemp)']
+        for index, command in enumerate(commands):
+            lines.extend([
+                f"printf '\\n{boundary} {index} out\\n'",
+                f'{{ timeout {timeout} {wrapper} {command}; }} < /dev/null 2> $err',
+                'code=$?',
+                f"printf '\\n{boundary} {index} err\\n'",
+                'cat $err',
+                f"printf '\\n{boundary} {index} code %s\\n' $code",
+            ])
+        lines.append('rm -f $err')
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, output, boundary):
+        records = {}
+        parts = re.split(f'\n{boundary} ([0-9]+) (out|err|code)(?: (-?[0-9]+))?\n', output)
+        # parts: leading text, then (index, kind, code, text) for each frame
+        for offset in range(1, len(parts) - 3, 4):
+            index, kind, code, text = parts[offset:offset + 4]
+            record = records.setdefault(int(index), {'out': '', 'err': '', 'code': ''})
+            if kind == 'code':
+                record['code'] = int(code)
+            else:
+                record[kind] = text
+        return records
+
+    def batch(self, where, commands, timeout):
+        # the results are already all available, they are returned
+        # as completed futures to be interchangeable with sweep
+        boundary = f'vyos-extra-{uuid.uuid4().hex}'
+
+        with tempfile.NamedTemporaryFile('w', suffix='.sh') as script:
+            script.write(self.script(commands, boundary, timeout))
+            script.flush()
+            out, _, _ = self.run(f"{config.ssh(where, 'bash -s')} < {script.name}", exitonfail=False, where=where)
+
+        records = self.parse(out, boundary)
+        for index, command in enumerate(commands):
+            record = records.get(index, None)
+            if record is None:
+                result = ('', '', '' if self.dry else 'no result from the router')
+            elif record['code'] == 124:
+                result = (record['out'], record['err'], f'no answer after {timeout} seconds')
+            else:
+                result = (record['out'], record['err'], '')
+
+            future = Future()
+            future.set_result(result)
+            yield command, future
+
+
+def classify(out, err):
+    # some command reply on stderr ! sigh !
+    if 'not configured' in err:
+        return 'skip', ''
+
+    for error in errors:
+        if error in err or error in out:
+            return 'fail', error
+
+    return 'pass', ''
+
+
 def running(command):
     sys.stdout.write(f'[{color.RUN}test{color.END}] {command}')
 
@@ -313,31 +410,31 @@ def failed(command, out, err, reason=''):
 def main():
     'test a VyOS router'
     arg = arguments.setup(__doc__, ['test'])
-    control = Control(arg.dry, not arg.quiet)
-
-    for command in commands:
-        show = f'/opt/vyatta/bin/vyatta-op-cmd-wrapper {command}'
-        running(command)
-        out, err = control.communicate(config.ssh(arg.machine, show))
-
-        # some command reply on stderr ! sigh !
-
-        if err:
-            if 'not configured' in err:
-                skipped(command)
-                continue
+    # the output of concurrent commands can not be streamed
+    control = Control(arg.dry, False)
 
-            for errror in errors:
-                if errror in err:
-                    failed(command, out, err, errror)
-                    continue
+    if arg.batch:
+        results = control.batch(arg.machine, commands, arg.timeout)
+    else:
+        results = control.sweep(arg.machine, commands, arg.jobs, arg.timeout)
 
-        for errror in errors:
-            if errror in out:
-                failed(command, out, err, errror)
-                continue
+    # with --quiet, only the failures are reported
+    for command, future in results:
+        if not arg.quiet:
+            running(command)
+        out, err, reason = future.result()
 
-        passed(command)
+        state, error = classify(out, err)
+        if reason:
+            failed(command, out, err, reason)
+        elif state == 'fail':
+            failed(command, out, err, error)
+        elif arg.quiet:
+            continue
+        elif state == 'skip':
+            skipped(command)
+        else:
+            passed(command)
 
 
 if __name__ == '__main__':
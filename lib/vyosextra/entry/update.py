@@ -2,10 +2,13 @@
 # encoding: utf-8
 
 import os
-import time
 import sys
+import time
+import tarfile
+import tempfile
 
 from vyosextra import log
+from vyosextra import watch
 from vyosextra import control
 from vyosextra import arguments
 
@@ -14,6 +17,12 @@ from vyosextra.config import config
 
 
 class Control(control.Control):
+    # the daemons keeping the code of these folders loaded
+    services = [
+        ('python/vyos/', 'vyos-configd'),
+        ('src/conf_mode/', 'vyos-configd'),
+    ]
+
     def permission(self, where, folder):
         user = config.get(where, 'user')
         with Repository(folder, verbose=self.verbose):
@@ -25,21 +34,89 @@ class Control(control.Control):
     def rsync(self, where, folder):
         with Repository(folder, verbose=self.verbose):
             for src, dst in self.move:
-                self.run(config.rsync(where, src, dst, exclude='**__pycache__'))
-
-    # there is no portable way, and python only to use inotify / etc.
-    def update(self, where, folder):
-        files = [os.path.join(dp, f) for dp, dn, fn in os.walk(os.path.expanduser(folder)) for f in fn]
-        modified = dict((f, os.path.getmtime(f)) for f in files if os.path.exists(f))
-        while True:
-            new_files = [os.path.join(dp, f) for dp, dn, fn in os.walk(os.path.expanduser(folder)) for f in fn]
-            new_modified = dict((f, os.path.getmtime(f)) for f in new_files if os.path.exists(f))
-
-            if new_modified != modified:
-                modified = new_modified
-                self.rsync(where, folder)
-
-            time.sleep(2)
+                self.run(config.rsync(where, src, dst, exclude='**__pycache__'), where=where)
+
+    def destination(self, path):
+        # where a file of the repository goes on the router, if anywhere
+        for src, dst in self.move:
+            prefix = os.path.dirname(src) + '/'
+            if path.startswith(prefix):
+                return os.path.join(dst, path[len(prefix) :])
+        return ''
+
+    @log.phase('push')
+    def push(self, where, folder, changed, deleted):
+        # one tar stream over the shared ssh connection, with the files
+        # stored under their router location, and the deletions
+        files = [(path, self.destination(path)) for path in sorted(changed)]
+        files = [(path, dst) for path, dst in files if dst and os.path.isfile(os.path.join(folder, path))]
+        removed = [dst for dst in (self.destination(path) for path in sorted(deleted)) if dst]
+
+        if not files and not removed:
+            return []
+
+        actions = []
+        if files:
+            actions.append('tar -C / -xf -')
+        if removed:
+            actions.append(f'rm -rf {" ".join(removed)}')
+        remote = config.ssh(where, ' && '.join(actions))
+
+        if self.verbose or self.dry:
+            for path, dst in files:
+                print(f'push   {path} -> {dst}')
+            for dst in removed:
+                print(f'remove {dst}')
+
+        if not files:
+            self.run(remote, where=where)
+            return []
+
+        with tempfile.NamedTemporaryFile(suffix='.tar') as archive:
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                for path, dst in files:
+                    tar.add(os.path.join(folder, path), arcname=dst.lstrip('/'))
+            archive.flush()
+            self.run(f'{remote} < {archive.name}', where=where)
+
+        return files
+
+    @log.phase('reload')
+    def reload(self, where, files):
+        # make the router use the code just pushed: remove stale python
+        # caches, check the code compiles, restart the daemons using it
+        scripts = [dst for _, dst in files if dst.endswith('.py')]
+        if not scripts:
+            return
+
+        checks = "import sys; [compile(open(f).read(), f, sys.argv[1]) for f in sys.argv[2:]]"
+        out, err, code = self.ssh(where, f"python3 -c '{checks}' exec {' '.join(scripts)}", exitonfail=False)
+        if code and not self.dry:
+            print(f'not reloading, the code does not compile:\n{err or out}')
+            return
+
+        caches = []
+        for script in scripts:
+            folder, name = os.path.split(script)
+            caches.append(f'{folder}/__pycache__/{name[:-3]}.*.pyc')
+
+        actions = [f'sudo rm -f {" ".join(caches)}']
+        services = sorted(set(service for path, _ in files for prefix, service in self.services if path.startswith(prefix)))
+        for service in services:
+            actions.append(f'if systemctl is-active --quiet {service}; then sudo systemctl restart {service}; fi')
+        self.ssh(where, '; '.join(actions), exitonfail=False)
+
+    def update(self, where, folder, reload=False):
+        # only the folders copied to the router are watched
+        roots = [os.path.dirname(src) for src, _ in self.move]
+        with watch.watcher(folder, roots) as watcher:
+            while True:
+                changed, deleted = watcher.wait()
+                files = self.push(where, watcher.folder, changed, deleted)
+                if reload:
+                    self.reload(where, files)
+                if files or deleted:
+                    print(f'live on {where} {time.monotonic() - watcher.since:.2f}s after the save')
 
 
 def main():
@@ -56,7 +133,7 @@ def main():
 
     control.permission(arg.router, arg.working)
     control.rsync(arg.router, arg.working)
-    control.update(arg.router, arg.working)
+    control.update(arg.router, arg.working, arg.reload)
 
 
 if __name__ == '__main__':
@@ -2,96 +2,311 @@
 # encoding: utf-8
 
 import os
+import re
 import sys
 import time
 import socket
-import shutil
-
-from threading import Thread
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from subprocess import TimeoutExpired
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 
+from vyosextra import log
+from vyosextra import server
 from vyosextra import control
 from vyosextra import arguments
 
+from vyosextra.store import regex_image
 from vyosextra.config import config
+from vyosextra.entry import test
 from vyosextra.entry.download import fetch
 
 
+# a few commands from "vyos test" telling if a rebooted router is usable
+health = [
+    'show version',
+    'show system image',
+    'show system uptime',
+    'show interfaces',
+]
+
+
+# the lines of "show system image", ie: "   1: 1.3-rolling-202010241631 (default boot) (running image)"
+regex_installed = re.compile(r'^\s*([0-9]+): (\S+)(.*)$', re.MULTILINE)
+
+
+# rsync --stats, ie: "Total bytes sent: 12.34M"
+regex_sent = re.compile(r'Total bytes sent: (\S+)')
+
+# where images are staged on the router, outside of any installed image,
+# so the last one can be the base of the next delta transfer
+staging = '/lib/live/mount/persistence/vyos-extra'
+
+
+def version(location):
+    # the VyOS version of an image, from its name (empty if not known)
+    match = regex_image.match(os.path.basename(location))
+    return match.group(1) if match else ''
+
+
 class Control(control.Control):
-    def upgrade(self, where, ip, location, local, remote, show):
+    def url(self, ip, image, local, remote):
         # local: your computer port
         # remote: the router port
-        image = location.split('/')[-1]
-
         if local and remote:
-            url = f'http://127.0.0.1:{remote}/{image}'
-            extra = f'-R {remote}:127.0.0.1:{local}'
-        else:
-            ip = ip if ip else socket.gethostbyname(socket.gethostname())
-            url = f'http://{ip}:{local}/{image}'
-            extra = ''
+            return f'http://127.0.0.1:{remote}/{image}', f'-R {remote}:127.0.0.1:{local}'
+
+        ip = ip if ip else socket.gethostbyname(socket.gethostname())
+        return f'http://{ip}:{local}/{image}', ''
+
+    def upgrade(self, where, ip, location, local, remote, show, force=False, method='http'):
+        # return True if the router must reboot to run the image
+        image = location.split('/')[-1]
+        url, extra = self.url(ip, image, local, remote)
 
         print(f'serving on: {url}')
         print(f'from image: {location}')
         if not show:
             web(location, image, local)
 
-        self.ssh(where, f"printf 'yes\n\nyes\nyes\nyes\n' | " f"sudo /opt/vyatta/sbin/install-image {url}", extra=extra)
-        self.ssh(where, 'printf 1 | ' '/opt/vyatta/bin/vyatta-boot-image.pl --select')
+        changed, error = self.deploy(where, location, url, extra, force, method)
+        if error:
+            log.failed(f'could not upgrade {where}: {error}', verbose=self.verbose)
+        return changed
+
+    def installed(self, where):
+        # the images on the router: {version: (index, default boot, running)}
+        out, _, _ = self.ssh(where, f'{test.wrapper} show system image', exitonfail=False)
+        images = {}
+        for index, name, flags in regex_installed.findall(out):
+            images[name] = (int(index), 'default boot' in flags, 'running image' in flags)
+        return images
+
+    def deploy(self, where, location, url, extra, force, method):
+        # only install the image if the router does not already have it, returns
+        # if the router must reboot to run it, and why it failed (empty if it worked)
+        wanted = version(location)
+        images = {} if force or not wanted else self.installed(where)
+        if wanted in images:
+            return self.existing(where, wanted, *images[wanted])
+
+        if method != 'http':
+            with log.phase(f'stage {method}', where):
+                url, error = self.stage(where, location, url, extra, method)
+            if error:
+                return False, error
+            extra = ''
+
+        with log.phase('install-image', where):
+            return True, self.install(where, url, extra)
+
+    def existing(self, where, wanted, index, default, running):
+        if default:
+            print(f'{where}: {wanted} is already the default image')
+            return not running, ''
+        print(f'{where}: {wanted} is already installed, making it the default')
+        return not running, self.select(where, index)
+
+    def stage(self, where, location, url, extra, method):
+        # copy the image on the router before installing it, returning where
+        # it is, and why it failed (empty if it worked)
+        image = os.path.basename(location)
+        staged = f'{staging}/{image}'
+        _, _, code = self.ssh(where, f'sudo mkdir -p {staging}', exitonfail=False)
+        if code and not self.dry:
+            return staged, f'could not create {staging}'
+
+        began = time.monotonic()
+        if method == 'delta':
+            # rsync finds the previous image (--fuzzy) and only sends what differs
+            options = "--fuzzy --stats --rsync-path='sudo rsync'"
+            out, _, code = self.run(config.rsync(where, location, staged, options=options), exitonfail=False, where=where)
+            match = regex_sent.search(out)
+            sent = match.group(1) if match else 'unknown'
+        else:
+            # the same url, through the same tunnel, but compressed by the server
+            out, _, code = self.ssh(
+                where,
+                f'sudo curl -sSf -o {staged}.gz {url}.gz && stat -c %s {staged}.gz && sudo gunzip -f {staged}.gz',
+                extra=extra,
+                exitonfail=False,
+            )
+            sent = out.split()[-1] if out.split() else 'unknown'
+        if code and not self.dry:
+            return staged, f'could not stage {image} ({method})'
+        duration = time.monotonic() - began
+
+        # only keep the last image, the base of the next delta
+        self.ssh(where, f"sudo find {staging} -name '*.iso' ! -name {image} -delete", exitonfail=False)
+        print(f'{where}: {image} staged in {duration:.1f}s, {sent} bytes received')
+        return staged, ''
+
+    def install(self, where, url, extra):
+        # why the installation failed, empty if it worked
+        command = f"printf 'yes\n\nyes\nyes\nyes\n' | " f"sudo /opt/vyatta/sbin/install-image {url}"
+        _, _, code = self.ssh(where, command, extra=extra, exitonfail=False)
+        if code and not self.dry:
+            return f'install-image failed with code {code}'
+        # the new image is the first one
+        return self.select(where, 1)
+
+    def select(self, where, index):
+        _, _, code = self.ssh(where, f'printf {index} | ' '/opt/vyatta/bin/vyatta-boot-image.pl --select', exitonfail=False)
+        if code and not self.dry:
+            return f'could not make image {index} the default'
+        return ''
 
     def reboot(self, where):
-        # should find a way to check if the image changed
         self.ssh(where, 'sudo reboot')
 
+    def boot(self, where):
+        # what identifies this boot of the router, empty if it does not answer;
+        # without the shared connection, which dies with a reboot
+        extra = '-o ControlPath=none -o ConnectTimeout=10 -o BatchMode=yes'
+        try:
+            out, _, code = self.ssh(where, 'cat /proc/sys/kernel/random/boot_id', extra=extra, exitonfail=False, timeout=15)
+        except TimeoutExpired:
+            return ''
+        return out.strip() if not code else ''
 
-def start_server(path, file, port):
-    class Handler(SimpleHTTPRequestHandler):
-        def do_GET(self):
-            if self.path != f'/{file}':
-                return
+    def restart(self, where, wait):
+        # reboot the router and wait for it to be back, False if it did not come back in time;
+        # a new boot id tells the router rebooted, it is not just still shutting down
+        before = self.boot(where)
+        self.ssh(where, 'sudo reboot', exitonfail=False)
+        if self.dry:
+            return True
 
-            with open(os.path.join(path, file), 'rb') as f:
-                fs = os.fstat(f.fileno())
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(5)
+            now = self.boot(where)
+            if now and now != before:
+                return True
+        return False
 
-                self.send_response(200)
-                self.send_header("Content-type", "application/octet-stream")
-                self.send_header("Content-Disposition", f'attachment; filename="{file}"')  # noqa: E501
-                self.send_header("Content-Length", str(fs.st_size))
-                self.end_headers()
+    def healthy(self, where, timeout):
+        # the reason the router is not healthy, empty if it is
+        tester = test.Control(self.dry, False)
+        for command in health:
+            out, err, reason = tester.show(where, command, timeout)
+            state, error = test.classify(out, err)
+            if reason or state == 'fail':
+                return f'"{command}" failed: {reason or error}'
+        return ''
 
-                shutil.copyfileobj(f, self.wfile)
+    def rollout(self, where, location, url, extra, force, method, reboot, wait, timeout):
+        # what was done to the router, and why it failed (empty if it worked)
+        try:
+            changed, error = self.deploy(where, location, url, extra, force, method)
+            if error:
+                return 'failed', error
+            if not changed:
+                return 'already running the image', ''
+            if not reboot:
+                return 'installed', ''
+            with log.phase('reboot', where):
+                if not self.restart(where, wait):
+                    return 'failed', f'not back after {wait} seconds'
+            with log.phase('health', where):
+                error = self.healthy(where, timeout)
+            return 'failed' if error else 'upgraded', error
+        except Exception as exc:
+            return 'failed', str(exc)
 
-    os.chdir(path)
-    httpd = HTTPServer(('', port), Handler)
-    httpd.serve_forever()
-    sys.exit(1)
+    def fleet(self, routers, ip, location, local, remote, show, force, method, reboot, canary, jobs, wait, timeout):
+        # the first "canary" routers are upgraded on their own, then the others
+        # "jobs" at a time; nothing new is started once one router failed
+        image = location.split('/')[-1]
+        url, extra = self.url(ip, image, local, remote)
 
+        print(f'serving on: {url}')
+        print(f'from image: {location}')
+        if not show:
+            web(location, image, local)
 
-def web(location, name, port):
-    daemon = Thread(name='serve VyOS', target=start_server, args=(os.path.dirname(location), name, port))
+        # the output of concurrent upgrades can not be streamed, and the
+        # errors are only reported once all of them are done
+        upgrader = type(self)(self.dry, False)
+        results = {}
+
+        def _wave(routers, jobs):
+            with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+                futures = {
+                    executor.submit(upgrader.rollout, router, location, url, extra, force, method, reboot, wait, timeout): router
+                    for router in routers
+                }
+                for future in as_completed(futures):
+                    router = futures[future]
+                    if future.cancelled():
+                        continue
+                    state, error = results[router] = future.result()
+                    print(f'{router:<20} {state}: {error}' if error else f'{router:<20} {state}')
+                    if error:
+                        for pending in futures:
+                            pending.cancel()
+            return not any(error for _, error in results.values())
+
+        canary = max(canary, 0)
+        if _wave(routers[:canary], 1):
+            _wave(routers[canary:], jobs)
 
-    daemon.setDaemon(True)
-    daemon.start()
+        failed = [router for router in routers if router in results and results[router][1]]
+        skipped = [router for router in routers if router not in results]
+        if skipped:
+            print(f'not upgraded: {", ".join(skipped)}')
+        if failed:
+            log.failed(f'rollout aborted, could not upgrade {", ".join(failed)}', verbose=self.verbose)
+
+
+def web(location, name, port):
+    # name is served, as well as any other image next to it
+    return server.serve(os.path.dirname(location), port)
 
 
 def main():
-    'upgrade router to latest VyOS image'
+    'upgrade router(s) to latest VyOS image'
     arg = arguments.setup(__doc__, ['upgrade'])
     control = Control(arg.dry, not arg.quiet)
 
-    if not config.exists(arg.router):
-        sys.exit(f'machine "{arg.router}" is not configured\n')
+    # before any work starts, so a mistyped name does not go unnoticed
+    unknown = config.unknown(arg.router)
+    if unknown:
+        sys.exit(f'no machine or group "{" ".join(unknown)}" is configured\n')
 
-    role = config.get(arg.router, 'role')
-    if role != 'router':
-        sys.exit(f'target "{arg.router}" is not a VyOS router\n')
+    routers = config.group(arg.router)
 
-    location = os.path.abspath(arg.iso) if arg.iso else fetch(arg.iso)
+    for router in routers:
+        role = config.get(router, 'role')
+        if role != 'router':
+            sys.exit(f'target "{router}" is not a VyOS router\n')
+
+    location = os.path.abspath(arg.iso) if arg.iso else fetch(arg.iso, checksum=arg.sha256)
 
     time.sleep(0.5)
-    control.upgrade(arg.router, arg.bind, location, arg.local, arg.remote, arg.dry)
-    if arg.reboot:
-        control.reboot(arg.router)
+    if len(routers) == 1:
+        changed = control.upgrade(routers[0], arg.bind, location, arg.local, arg.remote, arg.dry, arg.force, arg.stage)
+        if arg.reboot and changed:
+            control.reboot(routers[0])
+        elif arg.reboot:
+            print(f'{routers[0]}: already running the image, not rebooting')
+        return
+
+    control.fleet(
+        routers,
+        arg.bind,
+        location,
+        arg.local,
+        arg.remote,
+        arg.dry,
+        arg.force,
+        arg.stage,
+        arg.reboot,
+        arg.canary,
+        arg.jobs,
+        arg.wait,
+        arg.timeout,
+    )
+    log.completed('rollout completed')
 
 
 if __name__ == '__main__':
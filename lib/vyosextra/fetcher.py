@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import threading
+import urllib.request
+
+
+# how much is read from the network at once
+CHUNK = 256 * 1024
+
+# how long to wait for the server before giving up on a connection (seconds)
+TIMEOUT = 30
+
+
+def probe(url):
+    # the size of the file and if it can be downloaded in parts
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+        length = int(response.headers.get('Content-Length', 0) or 0)
+        ranged = response.headers.get('Accept-Ranges', '') == 'bytes'
+    return length, ranged and length > 0
+
+
+def published(url):
+    # the sha256 published next to the file, if there is one
+    for extension in ('.sha256', '.sha256sum'):
+        try:
+            with urllib.request.urlopen(url + extension, timeout=TIMEOUT) as response:
+                content = response.read().decode('utf-8', 'replace').split()
+        except (OSError, ValueError):
+            continue
+        if content and len(content[0]) == 64:
+            return content[0].lower()
+    return ''
+
+
+def sha256(location):
+    digest = hashlib.sha256()
+    with open(location, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK * 4), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Download(object):
+    '''
+    download a file using several HTTP range requests at once, written in
+    place in a preallocated "<location>.part" file; what was received is
+    recorded in "<location>.part.json" so an interrupted download resumes
+    '''
+
+    def __init__(self, url, location, connections=4, hook=None):
+        self.url = url
+        self.location = location
+        self.partial = f'{location}.part'
+        self.state = f'{location}.part.json'
+        self.connections = max(connections, 1)
+        self.hook = hook
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._errors = []
+        self.length = 0
+        self.ranges = []
+
+    def _load(self, length):
+        # ranges are [start, end (inclusive), bytes already written]
+        try:
+            with open(self.state) as f:
+                state = json.load(f)
+            if state['url'] == self.url and state['length'] == length and os.path.exists(self.partial):
+                return state['ranges']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        size = -(-length // self.connections)
+        return [[start, min(start + size, length) - 1, 0] for start in range(0, length, size)]
+
+    def _save(self):
+        with self._lock:
+            state = {'url': self.url, 'length': self.length, 'ranges': self.ranges}
+            with open(self.state, 'w') as f:
+                json.dump(state, f)
+
+    def received(self):
+        with self._lock:
+            return sum(done for _, _, done in self.ranges)
+
+    def _part(self, fd, part):
+        start, end, done = part
+        if start + done > end:
+            return
+
+        request = urllib.request.Request(self.url, headers={'Range': f'bytes={start + done}-{end}'})
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                # a server can answer a range covering the whole file with the whole file
+                whole = start + done == 0 and end == self.length - 1
+                if response.status != 206 and not (response.status == 200 and whole):
+                    raise IOError(f'the server ignored the range request ({response.status})')
+                while not self._stop.is_set() and start + part[2] <= end:
+                    data = response.read(min(CHUNK, end + 1 - start - part[2]))
+                    if not data:
+                        raise IOError('the connection was closed early')
+                    os.pwrite(fd, data, start + part[2])
+                    with self._lock:
+                        part[2] += len(data)
+        except Exception as exc:
+            self._errors.append(exc)
+            self._stop.set()
+
+    def _ranged(self):
+        fd = os.open(self.partial, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.length:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, self.length)
+                else:
+                    os.ftruncate(fd, self.length)
+
+            threads = [threading.Thread(target=self._part, args=(fd, part), daemon=True) for part in self.ranges]
+            for thread in threads:
+                thread.start()
+
+            try:
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(0.5)
+                        self._save()
+                        if self.hook:
+                            self.hook(self.received(), self.length)
+            finally:
+                # on ^C, let the threads write what they have before saving
+                self._stop.set()
+                for thread in threads:
+                    thread.join()
+                os.fsync(fd)
+                self._save()
+        finally:
+            os.close(fd)
+
+        if self._errors:
+            raise self._errors[0]
+
+    def _stream(self):
+        # the server does not support ranges, the only option is to restart
+        received = 0
+        with urllib.request.urlopen(self.url, timeout=TIMEOUT) as response, open(self.partial, 'wb') as f:
+            self.length = int(response.headers.get('Content-Length', 0) or 0)
+            for data in iter(lambda: response.read(CHUNK), b''):
+                f.write(data)
+                received += len(data)
+                if self.hook:
+                    self.hook(received, self.length)
+
+    def run(self):
+        length, ranged = probe(self.url)
+
+        if ranged:
+            self.length = length
+            self.ranges = self._load(length)
+            self._ranged()
+            if self.hook:
+                self.hook(self.received(), self.length)
+        else:
+            self._stream()
+
+        os.rename(self.partial, self.location)
+        if os.path.exists(self.state):
+            os.remove(self.state)
+        return self.location
+
+
+def download(url, location, connections=4, hook=None):
+    return Download(url, location, connections, hook).run()
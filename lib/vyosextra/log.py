@@ -1,14 +1,41 @@
-# import atexit
+import os
 import sys
+import json
+import time
+import atexit
+import itertools
+import contextlib
+import threading
 from datetime import datetime
+from collections import deque
 
-_records = []
+# only the most recent lines are kept for the failure report
+_records = deque(maxlen=5000)
+
+# the journal: every command, when it started and ended, its exit code and
+# how much it output, written as JSON lines as soon as it is known
+_journal = {'path': '', 'rotate': 0, 'file': None}
+_lock = threading.Lock()
+_running = {}
+
+# the phases timed, and the commands run if a trace is requested
+_phases = deque(maxlen=10000)
+_trace = {'path': '', 'commands': deque(maxlen=100000)}
+
+# time.monotonic() does not go back, but it has no meaning on its own
+_start = time.monotonic()
+_epoch = time.time()
 
 
 def _now():
     return datetime.now().strftime('%H:%M:%S')
 
 
+def _clock(monotonic):
+    # the time of day of a monotonic time, to the millisecond
+    return datetime.fromtimestamp(_epoch + monotonic - _start).strftime('%H:%M:%S.%f')[:-3]
+
+
 def timed(s):
     return f'{_now()} {s}'
 
@@ -20,17 +47,20 @@ def failed(string, verbose=True):
     sys.exit(1)
 
 
-def report():
+def report(header=''):
     special = []
 
+    if header:
+        print(header)
+
     for c, t, w, s in _records:
         # make iso reports error with 'E: ' lines
-        if w == 'answer' and s.startswith('E: '):
-            special.append()
+        if w == '<' and s.startswith('E: '):
+            special.append(s)
         if 'sudo: no tty present and no askpass program specified' in s:
             special.append('sudo is not setup to work without password')
             special.append('use sudo -S for your command')
-        print(f'{t} {c:>3} {w} {s}')
+        print(f'{_clock(t)} {c:>3} {w} {s}')
 
     if special:
         print()
@@ -39,30 +69,189 @@ def report():
             print(s)
         print()
 
+    if _journal['path']:
+        print(f'the full journal is {_journal["path"]}')
+
+
+def journal(path, rotate=0):
+    # where to write the journal (nowhere if empty), once it reaches "rotate"
+    # MB the previous one is moved to "<path>.1"
+    with _lock:
+        if _journal['file']:
+            _journal['file'].close()
+        _journal.update({'path': path, 'rotate': rotate, 'file': None})
+
 
-def _record(s, w='<', counter=[0]):
+def _open(path):
+    # the commands can include private details, only the user can read them
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a', buffering=1)
+
+
+def _write(entry):
+    if not _journal['path']:
+        return
+
+    entry['at'] = round(_epoch + entry['mono'] - _start, 6)
+    line = json.dumps(entry, sort_keys=True) + '\n'
+
+    with _lock:
+        try:
+            f = _journal['file']
+            if f is None:
+                f = _journal['file'] = _open(_journal['path'])
+            if _journal['rotate'] and f.tell() > _journal['rotate'] * 1024 * 1024:
+                f.close()
+                os.replace(_journal['path'], f'{_journal["path"]}.1')
+                f = _journal['file'] = _open(_journal['path'])
+            f.write(line)
+        except OSError:
+            # a journal we can not write must not stop the work
+            _journal['path'] = ''
+
+
+# next() on a count is atomic, commands can be run from threads
+_counter = itertools.count()
+
+
+def _record(s, w='<'):
     s = s.strip()
     if not s:
         return s
-    n = _now()
-    c = counter.pop()
-    counter.append(c + 1)
-    _records.append((c, n, w, s))
+    c = next(_counter)
+    _records.append((c, time.monotonic(), w, s))
     return f'{s}\n'
 
 
 def note(s):
+    _write({'kind': 'note', 'mono': time.monotonic(), 'text': s.strip()})
     return _record(s, '=')
 
 
-def command(s):
-    return _record(s, '>')
+def command(s, where=''):
+    # returns the id to give to ended once the command completed
+    c = next(_counter)
+    start = time.monotonic()
+    _records.append((c, start, '>', s.strip()))
+    _running[c] = (start, where, s.strip())
+    _write({'kind': 'start', 'id': c, 'mono': start, 'where': where, 'command': s.strip()})
+    return c
+
+
+def ended(c, code, out=0, err=0):
+    # out and err are how many bytes the command wrote on each
+    start, where, s = _running.pop(c, (time.monotonic(), '', ''))
+    end = time.monotonic()
+    if _trace['path']:
+        _trace['commands'].append((s, where, start, end, threading.get_ident(), code))
+    _write({
+        'kind': 'end',
+        'id': c,
+        'mono': end,
+        'where': where,
+        'command': s,
+        'start': round(start, 6),
+        'end': round(end, 6),
+        'duration': round(end - start, 6),
+        'code': code,
+        'stdout': out,
+        'stderr': err,
+    })
 
 
 def answer(s):
-    return _record(s)
+    # one record per line, sharing the time, so the deque bounds the memory
+    n = time.monotonic()
+    lines = [line.strip() for line in s.split('\n')]
+    _records.extend((next(_counter), n, '<', line) for line in lines if line)
+    return s
+
+
+class phase(contextlib.ContextDecorator):
+    '''
+    time a phase of the work, as a context manager:
+    "with log.phase('git pull', where):" or a decorator: "@log.phase('fetch')"
+    '''
+
+    def __init__(self, name, where=''):
+        self.name = name
+        self.where = where
+        self.start = 0.0
+
+    def _recreate_cm(self):
+        # a decorated function can be running in several threads at once
+        return phase(self.name, self.where)
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, rtype, rvalue, rtb):
+        _phases.append((self.name, self.where, self.start, time.monotonic(), threading.get_ident()))
+        return False
+
+
+def summary():
+    # how long each phase took, the longest first
+    if not _phases:
+        return
+
+    phases = {}
+    for name, where, start, end, _ in list(_phases):
+        label = f'{name} ({where})' if where else name
+        count, total, longest = phases.get(label, (0, 0.0, 0.0))
+        phases[label] = (count + 1, total + end - start, max(longest, end - start))
+
+    width = max(len(label) for label in phases)
+    print()
+    print(f'{"phase":<{width}} {"count":>5} {"total":>9} {"longest":>9}')
+    for label, (count, total, longest) in sorted(phases.items(), key=lambda _: -_[1][1]):
+        print(f'{label:<{width}} {count:>5} {total:>8.2f}s {longest:>8.2f}s')
+    print(f'{"wall time":<{width}} {"":>5} {time.monotonic() - _start:>8.2f}s')
+    print()
+
+
+def trace(path):
+    # save the phases and commands as a Chrome trace (chrome://tracing) on exit
+    if not _trace['path']:
+        atexit.register(_save_trace)
+    _trace['path'] = path
+
+
+def _save_trace():
+    pid = os.getpid()
+    threads = {}
+
+    def _event(name, category, where, start, end, thread, **args):
+        if where:
+            args['where'] = where
+        return {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - _start) * 1000000),
+            'dur': round((end - start) * 1000000),
+            'pid': pid,
+            'tid': threads.setdefault(thread, len(threads)),
+            'args': args,
+        }
+
+    events = [_event(name, 'phase', where, start, end, thread) for name, where, start, end, thread in list(_phases)]
+    events.extend(
+        _event(command[:80], 'command', where, start, end, thread, command=command, code=code)
+        for command, where, start, end, thread, code in list(_trace['commands'])
+    )
+
+    try:
+        with open(_trace['path'], 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    except OSError as exc:
+        print(f'could not save the trace: {exc}')
 
 
 def completed(s='completed'):
+    summary()
     print(timed(s))
     sys.exit(0)
@@ -25,6 +25,24 @@ def make_sys(extract=0):
     return extracted
 
 
+def strip(argv, flags, options):
+    # remove flags, and options with their value, from argv
+    stripped = []
+    skip = False
+    for word in argv:
+        if skip:
+            skip = False
+        elif word in flags:
+            pass
+        elif word in options:
+            skip = True
+        elif any(word.startswith(f'{option}=') for option in options):
+            pass
+        else:
+            stripped.append(word)
+    return stripped
+
+
 def _main():
     def intercept(dtype, value, trace):
         try:
@@ -55,6 +73,8 @@ def _main():
     )
     parser.add_argument('-h', '--help', help='show this help message and exit', action='store_true')
     parser.add_argument('command', help='command to run', nargs='?', choices=choices)
+    parser.add_argument('--profile', help='show where the time is spent (cProfile)', action='store_true')
+    parser.add_argument('--trace', metavar='FILE', help='save the timing of each phase and command as a Chrome trace')
 
     arg, _ = parser.parse_known_args()
 
@@ -66,8 +86,24 @@ def _main():
         parser.print_help()
         return
 
+    # the entry points do not know about these options
+    sys.argv = strip(sys.argv, ['--profile'], ['--trace'])
+    if arg.trace:
+        log.trace(os.path.abspath(arg.trace))
+
     make_sys()
-    register.call(arg.command)
+    if not arg.profile:
+        register.call(arg.command)
+        return
+
+    import pstats
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(register.call, arg.command)
+    finally:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
 
 
 def main():
@@ -1,16 +1,30 @@
+import importlib
+
+
 class Registerer(object):
     def __init__(self):
         self._register = {}
+        self._docs = {}
 
     def call(self, name, *args):
         return self._register[name](*args)
 
     def doc(self, name):
+        if name in self._docs:
+            return self._docs[name]
         return self._register[name].__doc__
 
     def registered(self):
         return list(self._register.keys())
 
+    def lazy(self, name, module, doc=''):
+        # the module is only imported when the function is called
+        def _main(*args):
+            return importlib.import_module(module).main(*args)
+
+        self._docs[name] = doc
+        self._register[name] = _main
+
     def _register_function(self, name, function):
         self._register[name] = function
 
@@ -1,5 +1,7 @@
 import os
 import re
+import shutil
+import tempfile
 
 from vyosextra import log
 from vyosextra import control
@@ -54,3 +56,20 @@ class Repository(control.Control):
         if not out:
             out = "vyos/0.0-no.git.tag"
         return out.replace('vyos/', f'{repo}_').replace('-dirty', '+dirty') + '_all.deb'
+
+    def tree(self):
+        # the git tree hash of the working directory as it is now, including
+        # uncommitted and untracked files, built in a copy of the index
+        index, _, code = self.run('git rev-parse --git-path index', exitonfail=False)
+        if code:
+            return ''
+
+        with tempfile.TemporaryDirectory() as folder:
+            scratch = os.path.join(folder, 'index')
+            if os.path.exists(index.strip()):
+                shutil.copy(index.strip(), scratch)
+            out, _, code = self.run(
+                f'GIT_INDEX_FILE={scratch} git add -A && GIT_INDEX_FILE={scratch} git write-tree', exitonfail=False
+            )
+
+        return out.strip() if not code else ''
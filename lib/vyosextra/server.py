@@ -0,0 +1,165 @@
+import os
+import re
+import sys
+import time
+import zlib
+import threading
+
+from http.server import ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler
+
+
+regex_range = re.compile(r'bytes=([0-9]*)-([0-9]*)$')
+
+# how much of an image is compressed at once
+CHUNK = 1024 * 1024
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    serve the VyOS images of a folder, with HEAD and Range support, using
+    sendfile so the data does not go through python; "<image>.gz" is the
+    image gzipped on the fly, for routers behind slow links
+    '''
+
+    folder = ''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _image(self):
+        name = self.path.split('?')[0].lstrip('/')
+        image = name[:-3] if name.endswith('.iso.gz') else name
+        if '/' in image or not image.endswith('.iso'):
+            return name, ''
+        path = os.path.join(self.folder, image)
+        return name, path if os.path.isfile(path) else ''
+
+    def _range(self, size):
+        # the (start, end) requested and if it was a range request, None if
+        # it can not be satisfied; an invalid Range is ignored (RFC 7233)
+        match = regex_range.match(self.headers.get('Range', '').strip())
+        if not match or not (match.group(1) or match.group(2)):
+            return 0, size - 1, False
+
+        first, last = match.groups()
+        if first and last and int(last) < int(first):
+            return 0, size - 1, False
+
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+
+        if start > end or start >= size:
+            return None
+        return start, end, True
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def _report(self, status, name, sent, began):
+        duration = max(time.monotonic() - began, 0.001)
+        rate = sent / duration / (1024 * 1024)
+        client = self.client_address[0]
+        sys.stdout.write(f'\n{status} {client} {name} {sent} bytes in {duration:.1f}s ({rate:.1f} MB/s)\n')
+
+    def _compressed(self, name, path, body):
+        # the size is not known in advance, the end of the data is the end of the connection
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'application/gzip')
+        self.send_header('Content-Disposition', f'attachment; filename="{name}"')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        if not body:
+            return
+
+        began = time.monotonic()
+        sent = 0
+        status = 'served'
+        # a low level keeps the compression faster than the network
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        try:
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(CHUNK), b''):
+                    data = compressor.compress(data)
+                    self.wfile.write(data)
+                    sent += len(data)
+            data = compressor.flush()
+            self.wfile.write(data)
+            sent += len(data)
+        except ConnectionError:
+            status = 'interrupted'
+
+        self._report(status, name, sent, began)
+
+    def _serve(self, body):
+        name, path = self._image()
+        if not path:
+            self.send_error(404)
+            return
+
+        if name.endswith('.gz'):
+            self._compressed(name, path, body)
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            requested = self._range(size)
+            if requested is None:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            # a range request is answered with a range, even if it is the whole file
+            start, end, partial = requested
+            length = end - start + 1
+
+            self.send_response(206 if partial else 200)
+            self.send_header('Content-type', 'application/octet-stream')
+            self.send_header('Content-Disposition', f'attachment; filename="{name}"')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(length))
+            if partial:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+
+            if not body:
+                return
+
+            began = time.monotonic()
+            try:
+                # socket.sendfile uses os.sendfile (zero-copy) when available
+                sent = self.connection.sendfile(f, start, length)
+                status = 'served'
+            except ConnectionError:
+                # the router gave up, it may come back with a Range request
+                sent = f.tell() - start
+                status = 'interrupted'
+                self.close_connection = True
+
+            self._report(status, name, sent, began)
+
+
+def serve(folder, port, bind=''):
+    # serve the images of folder from a background thread, one thread per client
+    class Images(Handler):
+        pass
+
+    Images.folder = folder
+
+    httpd = ThreadingHTTPServer((bind, port), Images)
+    httpd.daemon_threads = True
+
+    daemon = threading.Thread(name='serve VyOS', target=httpd.serve_forever)
+    daemon.daemon = True
+    daemon.start()
+    return httpd
@@ -0,0 +1,124 @@
+import os
+import re
+import json
+import time
+import collections
+
+from vyosextra import fetcher
+
+
+regex_image = re.compile(r'vyos-(.*?([0-9]{12})?)-amd64\.iso$')
+
+
+class Store(object):
+    '''
+    the downloaded VyOS images, with an index of their version, date,
+    size, sha256 and last use, plus a cache of the latest rolling name
+    '''
+
+    index = 'vyos-extra.json'
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.fname = os.path.join(folder, self.index)
+        self.data = {'images': {}, 'listing': {}}
+        try:
+            with open(self.fname) as f:
+                self.data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        if not os.path.isdir(self.folder):
+            return
+        tmp = f'{self.fname}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.fname)
+
+    def images(self):
+        # the indexed images still on disk, most recently used last
+        images = self.data['images']
+        for name in list(images):
+            if not os.path.exists(os.path.join(self.folder, name)):
+                del images[name]
+        return sorted(images.items(), key=lambda _: _[1]['used'])
+
+    def add(self, location):
+        name = os.path.basename(location)
+        match = regex_image.match(name)
+        stat = os.stat(location)
+        digest = fetcher.sha256(location)
+
+        # the same image under another name is only stored once
+        for other, entry in self.images():
+            if other != name and entry['sha256'] == digest:
+                os.remove(location)
+                os.link(os.path.join(self.folder, other), location)
+                break
+
+        self.data['images'][name] = {
+            'version': match.group(1) if match else '',
+            'date': (match.group(2) or '') if match else '',
+            'size': stat.st_size,
+            'sha256': digest,
+            'used': time.time(),
+        }
+        self.save()
+        return self.data['images'][name]
+
+    def use(self, location):
+        name = os.path.basename(location)
+        if name not in self.data['images']:
+            return self.add(location)
+        self.data['images'][name]['used'] = time.time()
+        self.save()
+        return self.data['images'][name]
+
+    def latest(self, ttl, lookup):
+        # the name of the latest rolling image, asking lookup at most every ttl seconds
+        listing = self.data['listing']
+        if listing.get('latest', '') and time.time() - listing.get('when', 0) < ttl:
+            return listing['latest']
+
+        latest = lookup()
+        if latest:
+            self.data['listing'] = {'latest': latest, 'when': time.time()}
+            self.save()
+        return latest
+
+    def _inodes(self, images):
+        # the same image stored under several names is hard linked (see add)
+        return {name: os.stat(os.path.join(self.folder, name)).st_ino for name, _ in images}
+
+    def used(self):
+        # the bytes used by the images, counting hard linked names once
+        images = self.images()
+        sizes = dict(zip(self._inodes(images).values(), (entry['size'] for _, entry in images)))
+        return sum(sizes.values())
+
+    def prune(self, capacity, keep=''):
+        # remove the least recently used images until they fit in capacity MB,
+        # the space of an image is only freed once its last name is removed
+        images = self.images()
+        inodes = self._inodes(images)
+        links = collections.Counter(inodes.values())
+        sizes = {inodes[name]: entry['size'] for name, entry in images}
+        used = sum(sizes.values())
+        removed = []
+
+        for name, entry in images:
+            if used <= capacity * 1024 * 1024:
+                break
+            inode = inodes[name]
+            if name == keep or inode == inodes.get(keep, None):
+                continue
+            os.remove(os.path.join(self.folder, name))
+            del self.data['images'][name]
+            removed.append(name)
+            links[inode] -= 1
+            if not links[inode]:
+                used -= sizes[inode]
+
+        self.save()
+        return removed
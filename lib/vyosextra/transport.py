@@ -0,0 +1,237 @@
+import os
+import re
+import uuid
+import hashlib
+import threading
+
+from subprocess import Popen
+from subprocess import PIPE
+from subprocess import DEVNULL
+
+from vyosextra.config import config
+
+
+class Local(object):
+    '''
+    run the commands on this machine, with the shell
+    '''
+
+    def spawn(self, cmd):
+        return Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
+
+    def pipe(self, cmd1, cmd2):
+        popen1 = Popen(cmd1, stdout=PIPE, stderr=DEVNULL, shell=True)
+        popen2 = Popen(cmd2, stdin=popen1.stdout, stdout=PIPE, stderr=PIPE, shell=True)
+        return popen1, popen2
+
+    async def aspawn(self, cmd):
+        import asyncio
+
+        return await asyncio.create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE)
+
+    async def apipe(self, cmd1, cmd2):
+        import asyncio
+
+        read, write = os.pipe()
+        process1 = await asyncio.create_subprocess_shell(cmd1, stdout=write, stderr=DEVNULL)
+        os.close(write)
+        process2 = await asyncio.create_subprocess_shell(cmd2, stdin=read, stdout=PIPE, stderr=PIPE)
+        os.close(read)
+        return process1, process2
+
+
+# the part of an ssh command line run on the remote machine
+regex_remote = re.compile(r'^ssh .*?\S+@\S+ "?(.*?)"?$', re.DOTALL)
+# the frames of the script run by "vyos test --batch"
+regex_frame = re.compile(r"printf '\\n(\S+) ([0-9]+) code")
+
+
+def _fill(lines, size):
+    # lines repeated until they are size bytes long
+    text = '\n'.join(lines) + '\n'
+    return (text * (size // len(text) + 1))[:size]
+
+
+def _batch(cmd, size):
+    # the frames of the script "vyos test --batch" gives to "bash -s"
+    if '<' not in cmd:
+        return '', '', 0
+    with open(cmd.rsplit('<', 1)[1].strip()) as f:
+        script = f.read()
+    frames = []
+    for boundary, index in regex_frame.findall(script):
+        frames.append(f'\n{boundary} {index} out\n{_fill(["show output"], size)}')
+        frames.append(f'\n{boundary} {index} err\n')
+        frames.append(f'\n{boundary} {index} code 0\n')
+    return ''.join(frames), '', 0
+
+
+def _fixed(out, code=0):
+    return lambda cmd, size: (out, '', code)
+
+
+def _filled(*lines):
+    # the lines repeated to make the output size
+    return lambda cmd, size: (_fill(lines, size), '', 0)
+
+
+_images = (
+    'The system currently has the following image(s) installed:\n\n'
+    '   1: 1.3-rolling-202001010000 (default boot) (running image)\n'
+    '   2: 1.3-rolling-201912310000\n'
+)
+
+# what a command would output (out, err, exit code) on a VyOS router or
+# build server, the first pattern found in the (remote) command is used
+replies = [
+    (re.compile(r'bash -s'), _batch),
+    (re.compile(r'show system image'), _fixed(_images)),
+    (re.compile(r'show version'), _fixed('Version:          VyOS 1.3-rolling-202001010000\nRelease train:    equuleus\n')),
+    (re.compile(r'vyatta-op-cmd-wrapper'), _filled('Interface        IP Address                        S/L  Description')),
+    (re.compile(r'docker image inspect'), lambda cmd, size: (f'sha256:{hashlib.sha256(cmd.encode()).hexdigest()}\n', '', 0)),
+    (re.compile(r'dpkg-buildpackage'), _filled('dpkg-buildpackage: info: source package vyos-1x', 'make[1]: Entering directory')),
+    (re.compile(r'docker run'), _filled('I: Configuring live-image', 'P: Begin installing packages...')),
+    (re.compile(r'dpkg -i'), _filled('Preparing to unpack ...', 'Setting up vyos-1x ...')),
+    (re.compile(r'install-image'), _filled('Checking SHA256 checksums of files on the ISO image... OK.', 'Done!')),
+    # every call is a new boot, so a reboot is always noticed
+    (re.compile(r'random/boot_id'), lambda cmd, size: (f'{uuid.uuid4()}\n', '', 0)),
+    # nothing was done before, nothing is cached
+    (re.compile(r'^test '), _fixed('', 1)),
+    (re.compile(r'(^| && )stat -c'), lambda cmd, size: (f'{size}\n', '', 0)),
+    (re.compile(r'^(rsync|scp) '), lambda cmd, size: (f'sent {size} bytes\nTotal bytes sent: {size}\n', '', 0)),
+]
+
+
+def answer(cmd, size):
+    remote = regex_remote.match(cmd)
+    command = remote.group(1) if remote else cmd
+    for pattern, reply in replies:
+        if pattern.search(command):
+            return reply(cmd, size)
+    return '', '', 0
+
+
+class _Popen(object):
+    # looks enough like subprocess.Popen for command._report
+
+    def __init__(self, cmd, latency, size, output=True):
+        self.args = cmd
+        self.returncode = None
+        self._done = threading.Event()
+        self._stop = threading.Event()
+        self.stdout = self.stderr = None
+        pipes = []
+        if output:
+            out_read, out_write = os.pipe()
+            err_read, err_write = os.pipe()
+            self.stdout = os.fdopen(out_read, 'rb', buffering=0)
+            self.stderr = os.fdopen(err_read, 'rb', buffering=0)
+            pipes = [out_write, err_write]
+        threading.Thread(target=self._answer, args=(cmd, latency, size, pipes), daemon=True).start()
+
+    def _answer(self, cmd, latency, size, pipes):
+        out, err, code = answer(cmd, size)
+        self._stop.wait(latency)
+        try:
+            for fd, data in zip(pipes, (out, err)):
+                if not self._stop.is_set():
+                    os.write(fd, data.encode())
+        except OSError:
+            pass
+        finally:
+            for fd in pipes:
+                os.close(fd)
+            self.returncode = -9 if self._stop.is_set() else code
+            self._done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        self._stop.set()
+
+    def communicate(self):
+        self.wait()
+        return b'', b''
+
+
+class _Stream(object):
+    # looks enough like asyncio.StreamReader for command._areport
+
+    def __init__(self, data, task):
+        self.data = data
+        self.task = task
+
+    async def read(self, size):
+        import asyncio
+
+        # nothing is output before the command "ran"
+        await asyncio.wait([self.task])
+        if self.task.cancelled():
+            return b''
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+class _Process(object):
+    # looks enough like asyncio.subprocess.Process for command._areport
+
+    def __init__(self, cmd, latency, size):
+        import asyncio
+
+        out, err, code = answer(cmd, size)
+        self._task = asyncio.ensure_future(asyncio.sleep(latency, code))
+        self.stdout = _Stream(out.encode(), self._task)
+        self.stderr = _Stream(err.encode(), self._task)
+
+    async def wait(self):
+        import asyncio
+
+        # asyncio.wait, so cancelling the caller does not cancel the command
+        await asyncio.wait([self._task])
+        return self.returncode
+
+    @property
+    def returncode(self):
+        if not self._task.done():
+            return None
+        return -9 if self._task.cancelled() else self._task.result()
+
+    def kill(self):
+        self._task.cancel()
+
+
+class Fake(Local):
+    '''
+    pretend to run the commands: ssh, vyatta-op-cmd-wrapper, dpkg, docker,
+    scp and rsync answer like on a router or build server, after "latency"
+    seconds and with "size" bytes of output, without running anything
+    '''
+
+    def __init__(self, latency=0.05, size=4096):
+        self.latency = latency
+        self.size = size
+
+    def spawn(self, cmd):
+        return _Popen(cmd, self.latency, self.size)
+
+    def pipe(self, cmd1, cmd2):
+        return _Popen(cmd1, self.latency, self.size, output=False), _Popen(cmd2, self.latency, self.size)
+
+    async def aspawn(self, cmd):
+        return _Process(cmd, self.latency, self.size)
+
+    async def apipe(self, cmd1, cmd2):
+        return _Process(cmd1, self.latency, self.size), _Process(cmd2, self.latency, self.size)
+
+
+def transport():
+    # the transport selected with VYOSEXTRA_TRANSPORT, or the configuration
+    name = os.environ.get('VYOSEXTRA_TRANSPORT', '') or config.get('global', 'transport')
+    if name == 'fake':
+        return Fake(config.get('global', 'latency'), config.get('global', 'output'))
+    return Local()
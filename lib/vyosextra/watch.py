@@ -0,0 +1,209 @@
+import os
+import time
+import struct
+import ctypes
+import ctypes.util
+import fnmatch
+import selectors
+
+
+# what is not worth reporting: git internals, python caches and editor files
+IGNORE = ('.git', '__pycache__', '*.swp', '*.swx', '*~', '.#*', '4913')
+
+
+class Poller(object):
+    '''
+    report the files created, modified or deleted under some folders by
+    comparing their modification times every "interval" seconds
+    '''
+
+    def __init__(self, folder, roots, ignore=IGNORE, debounce=0.1, interval=1.0):
+        self.folder = os.path.abspath(os.path.expanduser(folder))
+        self.roots = roots
+        self.ignore = ignore
+        self.debounce = debounce
+        self.interval = interval
+        # when the first change of the last batch was seen (time.monotonic)
+        self.since = 0.0
+        self._modified = self._scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, rtype, rvalue, rtb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def ignored(self, path):
+        return any(fnmatch.fnmatch(part, pattern) for part in path.split(os.sep) for pattern in self.ignore)
+
+    def _walk(self):
+        for root in self.roots:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self.folder, root)):
+                dirnames[:] = [_ for _ in dirnames if not self.ignored(_)]
+                for filename in filenames:
+                    path = os.path.relpath(os.path.join(dirpath, filename), self.folder)
+                    if not self.ignored(path):
+                        yield path
+
+    def _scan(self):
+        modified = {}
+        for path in self._walk():
+            try:
+                modified[path] = os.path.getmtime(os.path.join(self.folder, path))
+            except OSError:
+                pass
+        return modified
+
+    def wait(self):
+        # return the (changed, deleted) files, relative to folder
+        while True:
+            modified = self._scan()
+            if modified != self._modified:
+                break
+            time.sleep(self.interval)
+        self.since = time.monotonic()
+
+        # let a burst of saves settle before reporting it
+        time.sleep(self.debounce)
+        modified = self._scan()
+
+        changed = set(path for path, when in modified.items() if self._modified.get(path, None) != when)
+        deleted = set(self._modified) - set(modified)
+        self._modified = modified
+        return changed, deleted
+
+
+class Inotify(Poller):
+    '''
+    report the files created, modified or deleted under some folders as
+    soon as the kernel tells us about it (linux only)
+    '''
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    _event = struct.Struct('iIII')
+
+    def __init__(self, folder, roots, ignore=IGNORE, debounce=0.1):
+        self.folder = os.path.abspath(os.path.expanduser(folder))
+        self.roots = roots
+        self.ignore = ignore
+        self.debounce = debounce
+        self.since = 0.0
+
+        name = ctypes.util.find_library('c')
+        if not name:
+            raise OSError('can not find the C library')
+        self._libc = ctypes.CDLL(name, use_errno=True)
+
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._watches = {}
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._fd, selectors.EVENT_READ)
+
+        for root in self.roots:
+            self._watch(os.path.join(self.folder, root))
+
+    def close(self):
+        if self._fd < 0:
+            return
+        self._selector.close()
+        os.close(self._fd)
+        self._fd = -1
+
+    def _watch(self, directory):
+        # watch a folder and all its sub-folders, returning the files found
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [_ for _ in dirnames if not self.ignored(_)]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:
+                continue
+            self._watches[wd] = os.path.relpath(dirpath, self.folder)
+            found.update(os.path.relpath(os.path.join(dirpath, _), self.folder) for _ in filenames)
+        return set(_ for _ in found if not self.ignored(_))
+
+    def _events(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = data[offset : offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            yield wd, mask, name
+
+    def _read(self, changed, deleted):
+        for wd, mask, name in self._events():
+            if mask & self.IN_Q_OVERFLOW:
+                # some events were lost, consider everything changed
+                for root in self.roots:
+                    changed.update(self._watch(os.path.join(self.folder, root)))
+                continue
+
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+
+            directory = self._watches.get(wd, None)
+            if directory is None or not name:
+                continue
+
+            path = os.path.normpath(os.path.join(directory, name))
+            if self.ignored(path):
+                continue
+
+            if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                changed.discard(path)
+                deleted.add(path)
+            elif mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                # a new folder may already have content
+                deleted.discard(path)
+                changed.update(self._watch(os.path.join(self.folder, path)))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                deleted.discard(path)
+                changed.add(path)
+
+    def wait(self):
+        # return the (changed, deleted) files, relative to folder
+        changed = set()
+        deleted = set()
+
+        while not changed and not deleted:
+            self._selector.select()
+            self.since = time.monotonic()
+            self._read(changed, deleted)
+
+        # let a burst of saves settle before reporting it
+        while self._selector.select(self.debounce):
+            self._read(changed, deleted)
+
+        return changed, deleted
+
+
+def watcher(folder, roots, ignore=IGNORE, debounce=0.1):
+    # the best way available to be told about changes of files in roots
+    try:
+        return Inotify(folder, roots, ignore, debounce)
+    except (OSError, AttributeError):
+        return Poller(folder, roots, ignore, debounce)